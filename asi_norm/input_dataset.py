@@ -3,6 +3,35 @@ import utils.utilsgeo as ug
 from sklearn.preprocessing import StandardScaler
 from config import PATH
 import copy
+import os
+import importlib.util
+
+
+def _datastore():
+    # mycode/utils/datastore.py by path: asi_norm has its own ``utils`` package
+    spec = importlib.util.spec_from_file_location(
+        'datastore', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mycode', 'utils', 'datastore.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_arrays(path):
+    """
+    Open ``path`` + '.npz', preferring the memory-mapped store written by
+    mycode/utils/datastore.py (a directory with schema.json and one .npy per field).
+    The store is read with datastore.ColumnStore, which checks the schema version
+    and every field's dtype and shape.
+
+    :param path: dataset file path without extension
+    :return: mapping of field name to array
+    """
+
+    datastore = _datastore()
+    if datastore.is_store(path):
+        return datastore.ColumnStore(path)
+
+    return np.load(path + '.npz', allow_pickle=True)
 
 
 class Geds:
@@ -46,7 +75,7 @@ class Geds:
 
         assert isinstance(self.id_dataset, object)
 
-        data = np.load(PATH + '/datasets/'+ self.id_dataset + '/data_poi.npz', allow_pickle=True)
+        data = load_arrays(PATH + '/datasets/'+ self.id_dataset + '/data_poi')
 
         # original data
         X_train = data['X_train']
@@ -1,4 +1,5 @@
-import node2vec
+import time
+import node2vec_csr
 import numpy as np
 import networkx as nx
 from gensim.models import Word2Vec
@@ -11,8 +12,10 @@ walk_length = 80
 dimensions = 64
 window_size = 10
 iter = 1000
+workers = 8
 Adj_file = '../data/Adj.txt'
 SE_file = '../data/SE.txt'
+Walk_file = '../data/walks.txt'
 
 def read_graph(edgelist):
     G = nx.read_edgelist(
@@ -21,17 +24,41 @@ def read_graph(edgelist):
 
     return G
 
-def learn_embeddings(walks, dimensions, output_file):
-    walks = [list(map(str, walk)) for walk in walks]
+def write_walks(G, num_walks, walk_length, corpus_file):
+    # walks are generated batch by batch and appended to a text corpus
+    # (one space separated walk per line), never held in memory as a whole
+    labels = np.array([str(node) for node in G.nodes])
+    start = time.time()
+    total_walks = total_tokens = 0
+    with open(corpus_file, 'w') as fp:
+        for batch in G.iter_walk_batches(num_walks, walk_length, workers=workers):
+            lines = [' '.join(labels[walk[walk >= 0]]) for walk in batch]
+            fp.write('\n'.join(lines) + '\n')
+            total_walks += len(batch)
+            total_tokens += int(np.sum(batch >= 0))
+    elapsed = time.time() - start
+    print(f'walks: {total_walks} walks, {total_tokens} tokens in {elapsed:.1f}s '
+          f'({total_walks / elapsed:.0f} walks/s, {total_tokens / elapsed:.0f} tokens/s)')
+    return total_tokens
+
+def learn_embeddings(corpus_file, total_tokens, dimensions, output_file):
+    start = time.time()
     model = Word2Vec(
-        walks, size = dimensions, window = 10, min_count=0, sg=1,
-        workers = 8, iter = iter)
+        corpus_file = corpus_file, size = dimensions, window = 10, min_count=0, sg=1,
+        workers = workers, iter = iter)
     model.wv.save_word2vec_format(output_file)
+    elapsed = time.time() - start
+    print(f'word2vec: {total_tokens * iter} tokens in {elapsed:.1f}s ({total_tokens * iter / elapsed:.0f} tokens/s)')
 	
     return
-    
-nx_G = read_graph(Adj_file)
-G = node2vec.Graph(nx_G, is_directed, p, q)
-G.preprocess_transition_probs()
-walks = G.simulate_walks(num_walks, walk_length)
-learn_embeddings(walks, dimensions, SE_file)
\ No newline at end of file
+
+def main():
+    nx_G = read_graph(Adj_file)
+    G = node2vec_csr.CSRGraph(nx_G, is_directed, p, q)
+    G.preprocess_transition_probs(workers=workers)
+    total_tokens = write_walks(G, num_walks, walk_length, Walk_file)
+    learn_embeddings(Walk_file, total_tokens, dimensions, SE_file)
+
+# node2vec_csr's worker pool re-imports this module on spawn start methods
+if __name__ == '__main__':
+    main()
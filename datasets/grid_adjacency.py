@@ -0,0 +1,96 @@
+'''
+Grid-cell adjacency induced by the road network, used for the area embedding.
+
+Same definition as the AREA-EMBEDDING notebooks (two cells are linked once for
+every road segment crossing both, stored in adj[later_cell, earlier_cell]), but
+road/cell intersections come from one STRtree query over the grid and the
+counts are accumulated into a scipy.sparse matrix instead of a dense
+grid_num x grid_num array.
+'''
+
+import argparse
+import numpy as np
+import scipy.sparse as sp
+import shapely
+
+
+def grid_bounds(latlon, margin=0.01):
+    miny, minx = np.min(latlon, 0) - margin
+    maxy, maxx = np.max(latlon, 0) + margin
+    return minx, miny, maxx, maxy
+
+
+def grid_cells(bounds, ncols, nrows):
+    '''Cell boxes in row-major order: cell id = i + j * ncols (i along x, j along y).'''
+    minx, miny, maxx, maxy = bounds
+    width = (maxx - minx) / ncols
+    height = (maxy - miny) / nrows
+    i = np.tile(np.arange(ncols), nrows)
+    j = np.repeat(np.arange(nrows), ncols)
+    return shapely.box(minx + width * i, miny + height * j, minx + width * (i + 1), miny + height * (j + 1))
+
+
+def road_cells(road_geoms, bounds, ncols, nrows):
+    '''(road, cell) index pairs of every intersecting road/cell, sorted by road then cell.'''
+    tree = shapely.STRtree(grid_cells(bounds, ncols, nrows))
+    road_idx, cell_idx = tree.query(np.asarray(road_geoms, dtype=object), predicate='intersects')
+    order = np.lexsort((cell_idx, road_idx))
+    return road_idx[order], cell_idx[order]
+
+
+def build_grid_adjacency(road_geoms, bounds, ncols, nrows):
+    grid_num = ncols * nrows
+    road_idx, cell_idx = road_cells(road_geoms, bounds, ncols, nrows)
+
+    _, start, count = np.unique(road_idx, return_index=True, return_counts=True)
+    rows, cols = [], []
+    # roads crossing the same number of cells are paired up together
+    for m in np.unique(count[count > 1]):
+        first = start[count == m]
+        cells = cell_idx[first[:, None] + np.arange(m)]
+        a, b = np.triu_indices(m, 1)
+        rows.append(cells[:, b].ravel())
+        cols.append(cells[:, a].ravel())
+
+    if rows:
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+    else:
+        rows = cols = np.zeros(0, np.int64)
+    adj = sp.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(grid_num, grid_num)).tocsr()
+    adj.sum_duplicates()
+    adj.sort_indices()
+    return adj
+
+
+def write_edgelist(adj, path):
+    '''Adj-grid.txt format: "i j weight" per non-zero entry, row-major.'''
+    adj = adj.tocsr()
+    with open(path, 'w') as fp:
+        for i in range(adj.shape[0]):
+            for j, w in zip(adj.indices[adj.indptr[i]:adj.indptr[i + 1]], adj.data[adj.indptr[i]:adj.indptr[i + 1]]):
+                fp.write(f'{i} {j} {w}\n')
+
+
+if __name__ == '__main__':
+    import osmnx as ox
+
+    parser = argparse.ArgumentParser(description='road-induced grid adjacency')
+    parser.add_argument('--dataset', type=str, choices=['fc', 'kc', 'sp', 'poa'], default='fc')
+    parser.add_argument('--ncols', type=int, default=100)
+    parser.add_argument('--nrows', type=int, default=100)
+    args = parser.parse_args()
+
+    dname = args.dataset
+    data = np.load(f'{dname}/data.npz')
+    latlon = np.concatenate((data['X_train'][:, :2], data['X_test'][:, :2]), 0)
+
+    graph = ox.load_graphml(filepath=f'osmdata/{dname}.graphml')
+    _, osm_edges = ox.graph_to_gdfs(graph)
+    cond = np.array([str(type(s)) for s in osm_edges['highway']]) == "<class 'str'>"
+    osm_edges = osm_edges[cond]
+
+    adj = build_grid_adjacency(osm_edges.geometry.values, grid_bounds(latlon), args.ncols, args.nrows)
+    sp.save_npz(f'{dname}/adj-grid.npz', adj)
+    write_edgelist(adj, f'{dname}/Adj-grid.txt')
+    print(dname, adj.shape, adj.nnz)
@@ -0,0 +1,80 @@
+'''
+Gaussian smoothing of the grid (area) embedding.
+
+The AREA-EMBEDDING notebooks loop convolve2d over every channel of the
+(nrows, ncols, channels) grid and compute cell norms row by row. Here the whole
+tensor is smoothed in one pass, either with a single FFT (exact for the
+notebooks' boundary='wrap') or with scipy.ndimage, for any grid resolution.
+'''
+
+import argparse
+import numpy as np
+import scipy.fft
+from scipy.ndimage import convolve, gaussian_filter
+
+
+def notebook_kernel(sigma=1, size=5):
+    '''The kernel used by the notebooks: gaussian_filter(np.eye(size), sigma), normalised.'''
+    kernel = gaussian_filter(np.eye(size), sigma)
+    return kernel / kernel.sum()
+
+
+def gaussian_kernel(sigma=1, truncate=2.0):
+    '''Isotropic 2D Gaussian kernel of radius ceil(truncate * sigma), normalised.'''
+    radius = int(np.ceil(truncate * sigma))
+    x = np.arange(-radius, radius + 1)
+    g = np.exp(-x**2 / (2 * sigma**2))
+    kernel = np.outer(g, g)
+    return kernel / kernel.sum()
+
+
+def smooth_grid(image, kernel, method='fft'):
+    '''
+    Convolve every channel of ``image`` (nrows, ncols, channels) with ``kernel``
+    using periodic boundaries, i.e. convolve2d(mode='same', boundary='wrap')
+    applied channel by channel. The kernel sides must be odd: for an even side
+    the centre cell is ambiguous (convolve2d and scipy.ndimage put it one cell
+    apart), so the result would be shifted by one cell.
+    '''
+    image = np.asarray(image)
+    rows, cols = image.shape[:2]
+    kh, kw = kernel.shape
+    if kh % 2 == 0 or kw % 2 == 0:
+        raise ValueError(f'kernel sides must be odd, got {kernel.shape}')
+    if method == 'direct':
+        return convolve(image, kernel[:, :, np.newaxis], mode='wrap')
+    if method != 'fft':
+        raise ValueError(f'unknown method {method}')
+    if kh > rows or kw > cols:
+        raise ValueError('kernel larger than the grid')
+
+    # kernel centre moved to (0, 0) so the circular convolution is 'same'-aligned
+    padded = np.zeros((rows, cols))
+    padded[:kh, :kw] = kernel
+    padded = np.roll(padded, (-(kh // 2), -(kw // 2)), (0, 1))
+    spectrum = scipy.fft.rfft2(image, axes=(0, 1)) * scipy.fft.rfft2(padded)[:, :, np.newaxis]
+    return scipy.fft.irfft2(spectrum, s=(rows, cols), axes=(0, 1)).astype(image.dtype)
+
+
+def cell_norms(image):
+    return np.linalg.norm(image, axis=-1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='gaussian smoothing of grid vectors')
+    parser.add_argument('--dataset', type=str, choices=['fc', 'kc', 'sp', 'poa'], default='fc')
+    parser.add_argument('--ncols', type=int, default=100)
+    parser.add_argument('--nrows', type=int, default=100)
+    parser.add_argument('--sigma', type=float, default=1)
+    parser.add_argument('--kernel', type=str, choices=['notebook', 'gaussian'], default='notebook')
+    parser.add_argument('--method', type=str, choices=['fft', 'direct'], default='fft')
+    args = parser.parse_args()
+
+    dname = args.dataset
+    vectors = np.load(f'{dname}/grid_vectors.npy')
+    image = vectors.reshape(args.nrows, args.ncols, -1)
+    kernel = notebook_kernel(args.sigma) if args.kernel == 'notebook' else gaussian_kernel(args.sigma)
+
+    result = smooth_grid(image, kernel, args.method)
+    np.save(f'{dname}/grid_vectors_gaussian.npy', result.reshape(args.nrows * args.ncols, -1))
+    print(dname, result.shape, 'mean cell norm', cell_norms(image).mean(), '->', cell_norms(result).mean())
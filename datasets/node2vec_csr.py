@@ -0,0 +1,276 @@
+'''
+node2vec walks over a CSR graph.
+
+Drop-in replacement for node2vec.Graph: same constructor, same
+preprocess_transition_probs / simulate_walks calls and the same p/q-biased
+transition distribution, but every walker of a batch is advanced in lockstep
+with NumPy alias sampling and batches of start nodes are sharded over a
+process pool.
+
+Layout (n nodes, E directed edges):
+    indptr  (n + 1,)  neighbours of node u are indices[indptr[u]:indptr[u + 1]],
+    indices (E,)      sorted by node label like sorted(G.neighbors(u))
+    weights (E,)
+Alias tables are flat arrays aligned to that order: the first-order table of
+node u occupies the slots of its edges, and the second-order table of edge
+e = (src -> dst) occupies edge_ptr[e]:edge_ptr[e] + deg(dst). They are built
+vectorised (optionally over a process pool), or lazily in blocks of edges
+under a memory cap.
+'''
+
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+class CSRGraph():
+    def __init__(self, nx_G, is_directed, p, q):
+        self.is_directed = is_directed
+        self.p = p
+        self.q = q
+
+        self.nodes = list(nx_G.nodes())
+        position = {node: i for i, node in enumerate(self.nodes)}
+        indptr = [0]
+        indices = []
+        weights = []
+        for node in self.nodes:
+            for nbr in sorted(nx_G.neighbors(node)):
+                indices.append(position[nbr])
+                weights.append(nx_G[node][nbr]['weight'])
+            indptr.append(len(indices))
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.array(indices, dtype=np.int64)
+        self.weights = np.array(weights, dtype=np.float64)
+        self.degree = np.diff(self.indptr)
+        self.sources = np.repeat(np.arange(len(self.nodes)), self.degree)
+
+        # sorted (src * n + dst) keys for vectorised has_edge lookups
+        self._edge_keys = np.sort(self.sources * len(self.nodes) + self.indices)
+
+    @property
+    def num_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def num_edges(self):
+        return len(self.indices)
+
+    def has_edge(self, src, dst):
+        keys = np.asarray(src) * self.num_nodes + np.asarray(dst)
+        pos = np.minimum(np.searchsorted(self._edge_keys, keys), len(self._edge_keys) - 1)
+        return self._edge_keys[pos] == keys
+
+    def _edge_slots(self, edges):
+        # flat positions (into indices/weights) of the neighbours of dst for each edge
+        dst = self.indices[edges]
+        lengths = self.degree[dst]
+        ptr = np.zeros(len(edges) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=ptr[1:])
+        slots = np.repeat(self.indptr[dst] - ptr[:-1], lengths) + np.arange(ptr[-1])
+        return slots, ptr
+
+    def edge_probs(self, edges):
+        '''
+        Unnormalised second-order weights for every edge (src -> dst) in ``edges``,
+        concatenated over the neighbours of each dst: w/p back to src, w to
+        common neighbours, w/q otherwise. Returns (probs, segment pointers).
+        '''
+        edges = np.asarray(edges, dtype=np.int64)
+        slots, ptr = self._edge_slots(edges)
+        nbrs = self.indices[slots]
+        w = self.weights[slots]
+        src = np.repeat(self.sources[edges], np.diff(ptr))
+        probs = np.where(nbrs == src, w / self.p, np.where(self.has_edge(nbrs, src), w, w / self.q))
+        return probs, ptr
+
+    def edge_tables(self, edges):
+        probs, ptr = self.edge_probs(edges)
+        return alias_setup_segments(probs, ptr)
+
+    def preprocess_transition_probs(self, workers=1, chunk_edges=1 << 16, lazy=False, max_bytes=1 << 30):
+        '''
+        Preprocessing of transition probabilities for guiding the random walks.
+
+        lazy=True skips the second-order tables and builds them on demand, per
+        block of ``chunk_edges`` consecutive edges, keeping at most ``max_bytes``
+        of blocks in an LRU cache.
+        '''
+        E = self.num_edges
+        self.node_J, self.node_q = alias_setup_segments(self.weights, self.indptr)
+
+        self.edge_ptr = np.zeros(E + 1, dtype=np.int64)
+        np.cumsum(self.degree[self.indices], out=self.edge_ptr[1:])
+        self.chunk_edges = chunk_edges
+        self.lazy = lazy
+        self.max_bytes = max_bytes
+        self._blocks = OrderedDict()
+        self._block_bytes = 0
+        if lazy:
+            self.edge_J = self.edge_q = None
+            return
+
+        chunks = [np.arange(s, min(s + chunk_edges, E)) for s in range(0, E, chunk_edges)]
+        if workers == 1:
+            tables = list(map(self.edge_tables, chunks))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,)) as pool:
+                tables = list(pool.map(_edge_tables_job, chunks))
+        self.edge_J = np.concatenate([J for J, _ in tables]) if tables else np.zeros(0, dtype=np.int64)
+        self.edge_q = np.concatenate([q for _, q in tables]) if tables else np.zeros(0)
+        return
+
+    def _edge_block(self, block):
+        if block in self._blocks:
+            self._blocks.move_to_end(block)
+            return self._blocks[block]
+        s = block * self.chunk_edges
+        J, q = self.edge_tables(np.arange(s, min(s + self.chunk_edges, self.num_edges)))
+        self._blocks[block] = (J, q)
+        self._block_bytes += J.nbytes + q.nbytes
+        while self._block_bytes > self.max_bytes and len(self._blocks) > 1:
+            _, (oJ, oq) = self._blocks.popitem(last=False)
+            self._block_bytes -= oJ.nbytes + oq.nbytes
+        return J, q
+
+    def _edge_alias(self, edges, kk):
+        if not self.lazy:
+            slot = self.edge_ptr[edges] + kk
+            return self.edge_J[slot], self.edge_q[slot]
+        J = np.empty(len(edges), dtype=np.int64)
+        q = np.empty(len(edges))
+        blocks = edges // self.chunk_edges
+        for block in np.unique(blocks):
+            sel = np.flatnonzero(blocks == block)
+            bJ, bq = self._edge_block(block)
+            slot = self.edge_ptr[edges[sel]] - self.edge_ptr[block * self.chunk_edges] + kk[sel]
+            J[sel], q[sel] = bJ[slot], bq[slot]
+        return J, q
+
+    def walk_batch(self, starts, walk_length, rng):
+        '''
+        Walks from every node index in ``starts``, advanced together. Returns a
+        (len(starts), walk_length) array of node indices padded with -1 where a
+        walk reached a node without out-edges.
+        '''
+        starts = np.asarray(starts, dtype=np.int64)
+        walks = np.full((len(starts), walk_length), -1, dtype=np.int64)
+        walks[:, 0] = starts
+        cur = starts.copy()
+        edge = np.zeros(len(starts), dtype=np.int64)
+        active = self.degree[cur] > 0
+
+        for step in range(1, walk_length):
+            w = np.flatnonzero(active)
+            if len(w) == 0:
+                break
+            c = cur[w]
+            kk = (rng.random(len(w)) * self.degree[c]).astype(np.int64)
+            if step == 1:
+                slot = self.indptr[c] + kk
+                J, q = self.node_J[slot], self.node_q[slot]
+            else:
+                J, q = self._edge_alias(edge[w], kk)
+            choice = np.where(rng.random(len(w)) < q, kk, J)
+
+            edge[w] = self.indptr[c] + choice
+            cur[w] = self.indices[edge[w]]
+            walks[w, step] = cur[w]
+            active[w] = self.degree[cur[w]] > 0
+        return walks
+
+    def iter_walk_batches(self, num_walks, walk_length, batch_size=10000, workers=1, seed=None):
+        '''
+        Yield (batch, walk_length) index arrays; per walk iteration every node
+        starts one walk, in shuffled order as in node2vec.Graph.simulate_walks.
+        '''
+        seq = np.random.SeedSequence(seed)
+        order_rng = np.random.default_rng(seq.spawn(1)[0])
+        jobs = []
+        for walk_iter in range(num_walks):
+            nodes = order_rng.permutation(self.num_nodes)
+            for s in range(0, len(nodes), batch_size):
+                jobs.append(nodes[s:s + batch_size])
+        job_seeds = seq.spawn(len(jobs))
+
+        workers = workers or os.cpu_count()
+        if workers == 1:
+            for starts, job_seed in zip(jobs, job_seeds):
+                yield self.walk_batch(starts, walk_length, np.random.default_rng(job_seed))
+            return
+
+        # keep a bounded number of batches in flight so a slow consumer does not
+        # make finished walks pile up in memory
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,)) as pool:
+            pending = deque()
+            for starts, job_seed in zip(jobs, job_seeds):
+                pending.append(pool.submit(_walk_job, starts, walk_length, job_seed))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def simulate_walks(self, num_walks, walk_length, batch_size=10000, workers=1, seed=None):
+        '''
+        Repeatedly simulate random walks from each node; returns lists of node labels.
+        '''
+        nodes = self.nodes
+        walks = []
+        for batch in self.iter_walk_batches(num_walks, walk_length, batch_size, workers, seed):
+            for walk in batch:
+                walks.append([nodes[i] for i in walk[walk >= 0]])
+        return walks
+
+
+def alias_setup_segments(probs, ptr):
+    '''
+    Alias tables for many discrete distributions at once. Segment s is
+    probs[ptr[s]:ptr[s + 1]] (unnormalised); J holds indices local to the segment.
+
+    Segments of equal length are processed together: each of the m - 1 rounds
+    pairs the smallest remaining entry of every row with its largest one, which
+    yields a valid alias table without a per-distribution Python loop.
+    '''
+    probs = np.asarray(probs, dtype=np.float64)
+    J = np.zeros(len(probs), dtype=np.int64)
+    q = np.zeros(len(probs), dtype=np.float64)
+    lengths = np.diff(ptr)
+    for m in np.unique(lengths[lengths > 0]):
+        slots = ptr[:-1][lengths == m][:, None] + np.arange(m)
+        J[slots], q[slots] = _alias_rows(probs[slots])
+    return J, q
+
+
+def _alias_rows(P):
+    r, m = P.shape
+    rows = np.arange(r)
+    q = m * P / P.sum(1, keepdims=True)
+    J = np.tile(np.arange(m), (r, 1))
+    done = np.zeros((r, m), dtype=bool)
+    for _ in range(m - 1):
+        small = np.argmin(np.where(done, np.inf, q), 1)
+        large = np.argmax(np.where(done, -np.inf, q), 1)
+        q_small = q[rows, small]
+        J[rows, small] = large
+        q[rows, large] -= 1.0 - q_small
+        q[rows, small] = q_small
+        done[rows, small] = True
+    q[~done] = 1.0
+    return J, q
+
+
+_worker_graph = None
+
+
+def _init_worker(graph):
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _edge_tables_job(edges):
+    return _worker_graph.edge_tables(edges)
+
+
+def _walk_job(starts, walk_length, seed):
+    return _worker_graph.walk_batch(starts, walk_length, np.random.default_rng(seed))
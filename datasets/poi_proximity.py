@@ -0,0 +1,137 @@
+'''
+Nearest-POI distances for every house, one column per OSM category.
+
+Replaces the per-category ``house_gdf.distance(mbuildings.unary_union)`` loop of
+the POI-extraction notebooks: each layer in osm_poi/<city>/ is loaded into a
+shapely STRtree and all houses are resolved with one bulk nearest query.
+Categories run in a process pool and every result is cached on disk under a
+hash of the geojson content and the house coordinates, so changing beta (or
+re-running the notebook) never recomputes distances.
+'''
+
+import os
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
+import geopandas as gpd
+
+tag_dict_list = [
+    {'amenity': 'hospital'},
+    {'amenity': 'university'},
+    {'amenity': 'school'},
+    {'amenity': 'place_of_worship'},
+    {'landuse': 'cemetery'},
+    {'landuse': 'commercial'},
+    {'landuse': 'industrial'},
+    {'landuse': 'retail'},
+    {'landuse': 'railway'},
+    {'leisure': 'golf_course'},
+    {'leisure': 'park'},
+    {'leisure': 'sports_centre'},
+    {'natural': 'water'},
+    {'natural': 'wood'},
+    {'aeroway': 'aerodrome'}
+]
+
+# the notebooks only keep plain polygons of each layer
+GEOM_TYPES = ('Polygon',)
+
+
+def category_names(tag_dicts=tag_dict_list):
+    return [','.join(['-'.join(items) for items in ttag_dict.items()]) for ttag_dict in tag_dicts]
+
+
+def cache_key(geojson_path, latlon, geom_types=GEOM_TYPES):
+    h = hashlib.sha1()
+    with open(geojson_path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            h.update(block)
+    h.update(np.ascontiguousarray(latlon, dtype=np.float64).tobytes())
+    h.update(','.join(geom_types).encode())
+    return h.hexdigest()
+
+
+def load_layer(geojson_path, geom_types=GEOM_TYPES):
+    gdf = gpd.read_file(geojson_path)
+    gdf = gdf[gdf.geometry.type.isin(geom_types)]
+    return np.asarray(gdf.geometry.values, dtype=object)
+
+
+def nearest_distance(geoms, latlon):
+    '''Planar distance (degrees) from every (lat, lon) to the closest geometry; 0 if there is none.'''
+    if len(geoms) == 0:
+        return np.zeros(len(latlon))
+    points = shapely.points(latlon[:, 1], latlon[:, 0])
+    tree = shapely.STRtree(geoms)
+    (house_idx, _), dist = tree.query_nearest(points, return_distance=True, all_matches=False)
+    out = np.empty(len(latlon))
+    out[house_idx] = dist
+    return out
+
+
+def _category_distance(job):
+    geojson_path, latlon, cache_file, geom_types = job
+    if cache_file is not None and os.path.isfile(cache_file):
+        return np.load(cache_file)
+    if os.path.isfile(geojson_path):
+        dist = nearest_distance(load_layer(geojson_path, geom_types), latlon)
+    else:
+        print(f'{geojson_path} not found, distances set to 0')
+        dist = np.zeros(len(latlon))
+    if cache_file is not None:
+        tmp = cache_file + '.tmp.npy'
+        np.save(tmp, dist)
+        os.replace(tmp, cache_file)
+    return dist
+
+
+def poi_distances(dname, latlon, root='osm_poi', cache_dir='cache/poi', workers=None,
+                  categories=None, geom_types=GEOM_TYPES):
+    '''
+    (num_houses, num_categories) nearest-POI distances, columns in ``categories``
+    order (tag_dict_list order by default, as stored in Train_poidist).
+    '''
+    latlon = np.asarray(latlon, dtype=np.float64)
+    categories = category_names() if categories is None else categories
+    if cache_dir is not None:
+        os.makedirs(f'{cache_dir}/{dname}', exist_ok=True)
+
+    jobs = []
+    for fname in categories:
+        path = f'{root}/{dname}/{fname}.geojson'
+        cache_file = None
+        if cache_dir is not None and os.path.isfile(path):
+            cache_file = f'{cache_dir}/{dname}/{fname}-{cache_key(path, latlon, geom_types)}.npy'
+        jobs.append((path, latlon, cache_file, geom_types))
+
+    if workers == 1:
+        columns = list(map(_category_distance, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            columns = list(pool.map(_category_distance, jobs))
+    return np.stack(columns, -1)
+
+
+def poi_proximity(dist, beta):
+    return np.exp(-(dist / beta)**2 / 2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='nearest POI distances per house')
+    parser.add_argument('--dataset', type=str, choices=['fc', 'kc', 'sp', 'poa'], default='fc')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--cache_dir', type=str, default='cache/poi')
+    args = parser.parse_args()
+
+    dname = args.dataset
+    data = np.load(f'{dname}/data.npz')
+    num_train = len(data['X_train'])
+    latlon = np.concatenate((data['X_train'][:, :2], data['X_test'][:, :2]), 0)
+
+    dist = poi_distances(dname, latlon, cache_dir=args.cache_dir, workers=args.workers)
+    os.makedirs(f'processed/{dname}', exist_ok=True)
+    np.savez(f'processed/{dname}/poidist.npz', Train_poidist=dist[:num_train], Test_poidist=dist[num_train:])
+    for fname, column in zip(category_names(), dist.T):
+        print(fname, np.std(column))
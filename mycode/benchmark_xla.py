@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Speed and accuracy of the XLA / reduced-precision execution mode against the
+default one. Both runs train the same model from the same seed for
+--bench_epochs epochs on the same data, then predict the test set:
+
+    python benchmark_xla.py --dataset fc --use_areaemb --use_poiprox --jit_compile --precision mixed_bfloat16
+
+The baseline is the given configuration with --jit_compile off and float32.
+'''
+
+import copy
+import time
+import numpy as np
+from tensorflow import keras
+import utils
+from train_addr import get_parser, model_define, compile_model, check_args
+
+
+def run(args, metadata, dataset, seed):
+    X_train, Nidx_train, Ndist_train, Eidx_train, Edist_train, y_train, \
+            X_test , Nidx_test , Ndist_test , Eidx_test, Edist_test, y_test = dataset
+    test_inputs = (X_test, Nidx_test, Ndist_test, Eidx_test, Edist_test)
+
+    utils.set_precision(args.precision)
+    keras.utils.set_random_seed(seed)
+    model, _ = model_define(args, metadata)
+    compile_model(model, args)
+
+    throughput = utils.ThroughputCallback(args.batch_size)
+    start = time.perf_counter()
+    history = model.fit((X_train, Nidx_train, Ndist_train, Eidx_train, Edist_train), y_train,
+                        batch_size=args.batch_size, validation_split=args.val_ratio,
+                        epochs=args.bench_epochs, verbose=0, callbacks=[throughput])
+    train_time = time.perf_counter() - start
+
+    model.predict(test_inputs, batch_size=args.batch_size, verbose=0)   # compile / warm up
+    start = time.perf_counter()
+    y_pred = model.predict(test_inputs, batch_size=args.batch_size, verbose=0)
+    predict_time = time.perf_counter() - start
+
+    return dict(train_time=train_time,
+                # first epoch includes tracing / compilation
+                steps_per_sec=float(np.mean(history.history['steps_per_sec'][1:] or history.history['steps_per_sec'])),
+                predict_time=predict_time,
+                metric=utils.metric(np.exp(y_test), np.exp(y_pred)))
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument('--bench_epochs', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    check_args(parser, args)
+    if args.jit_compile:
+        utils.enable_compilation_cache(args.xla_cache_dir)
+
+    dataset, metadata = utils.dataloader.load_data_ours(args)
+
+    baseline_args = copy.copy(args)
+    baseline_args.jit_compile = False
+    baseline_args.precision = 'float32'
+
+    baseline = run(baseline_args, metadata, dataset, args.seed)
+    candidate = run(args, metadata, dataset, args.seed)
+
+    print(f'{"":>24}{"baseline":>18}{"candidate":>18}')
+    print(f'{"jit_compile / precision":>24}{"off/float32":>18}{("on" if args.jit_compile else "off") + "/" + args.precision:>18}')
+    print(f'{"train time (s)":>24}{baseline["train_time"]:>18.2f}{candidate["train_time"]:>18.2f}')
+    print(f'{"train steps/sec":>24}{baseline["steps_per_sec"]:>18.1f}{candidate["steps_per_sec"]:>18.1f}')
+    print(f'{"predict time (s)":>24}{baseline["predict_time"]:>18.3f}{candidate["predict_time"]:>18.3f}')
+    for name, b, c in zip(('MALE', 'RMSE', 'MAPE'), baseline['metric'], candidate['metric']):
+        print(f'{name:>24}{b:>18.4f}{c:>18.4f}   delta {c - b:+.4f}')
+    print(f'train speedup {candidate["steps_per_sec"] / baseline["steps_per_sec"]:.2f}x, '
+          f'predict speedup {baseline["predict_time"] / candidate["predict_time"]:.2f}x')
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Latency vs accuracy of a trained model when only the nearest K' neighbors of
+each branch are used at inference (AMMASI.set_neighbors). Loads the checkpoint
+train_addr.py wrote for the same arguments, predicts the test split for every
+K' and marks the Pareto-optimal points (no other K' is both faster and more
+accurate):
+
+    python calibrate_neighbors.py --dataset fc --use_areaemb --use_poiprox --ks 1,2,4,8,16,30
+'''
+
+import os
+import time
+import logging
+import numpy as np
+import utils
+from train_addr import get_parser, model_define, compile_model, predict_metric, get_logging_name, attention_layer
+
+
+def pareto_front(latency, error):
+    '''Points not dominated by another point with lower-or-equal latency and error (one of them lower).'''
+    latency, error = np.asarray(latency), np.asarray(error)
+    dominated = [np.any((latency <= l) & (error <= e) & ((latency < l) | (error < e))) for l, e in zip(latency, error)]
+    return ~np.array(dominated)
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument('--ks', type=utils.int_list, default=None) # comma separated neighbor counts, default powers of 2 and all
+    parser.add_argument('--repeats', type=int, default=3) # timed predictions per K', the fastest is reported
+    args = parser.parse_args()
+    if args.jit_compile:
+        parser.error('the neighbor count is a dynamic width and cannot be jit-compiled')
+
+    utils.set_precision(args.precision)
+    dataset, metadata = utils.dataloader.load_data_ours(args)
+    X_train, Nidx_train, Ndist_train, Eidx_train, Edist_train, y_train, \
+            X_test , Nidx_test , Ndist_test , Eidx_test, Edist_test, y_test = dataset
+    if np.any(np.diff(Ndist_test, axis=1) < 0) or np.any(np.diff(Edist_test, axis=1) < 0):
+        # attention does not depend on the column order, truncation does
+        Nidx_test, Ndist_test = utils.dataloader.sort_by_distance(Nidx_test, Ndist_test)
+        Eidx_test, Edist_test = utils.dataloader.sort_by_distance(Eidx_test, Edist_test)
+    test_inputs = (X_test, Nidx_test, Ndist_test, Eidx_test, Edist_test)
+
+    model, model_name = model_define(args, metadata)
+    model_logging_name = get_logging_name(args, model_name)
+    model_checkpoint = f'./model_checkpoint/{args.dataset}/{model_logging_name}'
+    if not os.path.exists(model_checkpoint + '.npz'):
+        parser.error(f'no checkpoint {model_checkpoint}, train it with train_addr.py and the same arguments')
+    model.set_weights(utils.read_weights(model_checkpoint + '.npz'))
+    compile_model(model, args)
+    layer = attention_layer(model)
+
+    num_neighbors = metadata['num_neighbors']
+    ks = sorted(set(min(k, num_neighbors) for k in args.ks)) if args.ks else \
+            sorted({k for k in (1, 2, 4, 8, 16, 32, 64, 128) if k < num_neighbors} | {num_neighbors})
+
+    logging.basicConfig(filename=f'./test_logs/{args.dataset}/{model_logging_name}_neighbors.log', level=logging.INFO, format='%(asctime)s - %(message)s', filemode='w')
+    logging.info(str(args))
+
+    results = []
+    for k in ks:
+        layer.set_neighbors(k)
+        _, metric = predict_metric(model, args, test_inputs, y_test)    # warm-up
+        timings = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            predict_metric(model, args, test_inputs, y_test)
+            timings.append(time.perf_counter() - start)
+        results.append((k, min(timings)) + tuple(metric))
+        logging.info(f'Test: \t{model_name} \t {args.dataset} \t neighbors {k} \t {min(timings):.4f}s \t {metric}')
+
+    ks, latency, male, rmse, mape = (np.array(c) for c in zip(*results))
+    front = pareto_front(latency, male)
+    print(f'{"K":>5}{"time(s)":>9}{"us/house":>10}{"MALE":>9}{"RMSE":>12}{"MAPE":>9}  pareto')
+    for i in range(len(ks)):
+        print(f'{ks[i]:>5}{latency[i]:>9.3f}{latency[i] / len(y_test) * 1e6:>10.1f}{male[i]:>9.4f}{rmse[i]:>12.1f}{mape[i]:>9.4f}  {"*" if front[i] else ""}')
+    logging.info(f'Pareto front (K, seconds, MALE): {[(int(k), float(t), float(e)) for k, t, e in zip(ks[front], latency[front], male[front])]}')
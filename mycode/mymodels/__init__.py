@@ -2,6 +2,7 @@ from mymodels.neighbor_attention import *
 from mymodels.neighbor import *
 from mymodels.basic import *
 from mymodels.naive import *
+from mymodels.stacked import *
 # from mymodels.rgat import *
 
 import numpy as np
@@ -0,0 +1,49 @@
+import numpy as np
+import tensorflow as tf
+
+
+_tables = {}
+
+
+class AreaEmbedding:
+    '''
+    (cells, channels) area embedding table, materialised on first use as one
+    non-trainable variable and shared by every model built in the process from
+    the same source. Layers gather rows from it instead of capturing the grid
+    as a graph constant, so it is neither copied into every traced function
+    nor written into checkpoints.
+    '''
+    def __init__(self, load):
+        self.load = load    # () -> (cells, channels) array
+        self._table = None
+
+    @property
+    def table(self):
+        if self._table is None:
+            with tf.init_scope():
+                self._table = tf.Variable(np.asarray(self.load(), dtype=np.float32), trainable=False, name='area_embedding')
+        return self._table
+
+    @property
+    def shape(self):
+        return tuple(self.table.shape)
+
+
+def shared_area_embedding(key, load):
+    '''The AreaEmbedding registered under ``key``, created with ``load`` on first request.'''
+    if key not in _tables:
+        _tables[key] = AreaEmbedding(load)
+    return _tables[key]
+
+
+def load_flat(path, full=False):
+    '''
+    Memory-mapped lookup table of a saved grid embedding. By default the saved
+    array is flattened as the original model did, reshape(shape[0] * shape[1], -1):
+    a (nrows, ncols, C) grid gives (cells, C) rows, a (nrows * ncols, C) one a
+    column of scalars. ``full`` always gives (cells, C) rows (--area_emb_full).
+    '''
+    table = np.load(path, mmap_mode='r')
+    if full:
+        return table.reshape(-1, table.shape[-1])
+    return table.reshape(table.shape[0] * table.shape[1], -1)
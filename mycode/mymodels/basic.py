@@ -217,6 +217,46 @@ from tensorflow.keras import *
     
 import tensorflow as tf
 from positional_encodings.tf_encodings import TFPositionalEncoding2D, TFSummer
+from mymodels.kv_cache import NeighborKVCache
+from mymodels.area_embedding import shared_area_embedding, load_flat
+from mymodels.feature_store import feature_store
+
+
+class RuntimeParams:
+    '''
+    Scalar hyperparameters held as tf.Variables outside the layer's weights:
+    traced graphs read them at run time, so set() takes effect without a
+    rebuild or retrace, and checkpoints do not carry them.
+    '''
+    def __init__(self, **values):
+        with tf.init_scope():
+            for name, value in values.items():
+                setattr(self, name, tf.Variable(float(value), trainable=False, name=name))
+
+    def set(self, **values):
+        for name, value in values.items():
+            if value is not None:
+                getattr(self, name).assign(float(value))
+
+
+def sinusoidal_grid(nrows, ncols, channels=64):
+    '''(nrows * ncols, channels) 2D sinusoidal encoding of the grid cells.'''
+    image = TFPositionalEncoding2D(channels)(tf.zeros((1, nrows, ncols, channels))).numpy()
+    return image.reshape(nrows * ncols, channels)
+
+
+def area_embedding_for(args, metadata):
+    '''The shared area embedding table selected by args (sinusoidal or npy, grid or quadtree cells).'''
+    nrows, ncols = metadata['nrows'], metadata['ncols']
+    if args.use_sinusoidal:
+        key, load = ('sinusoidal', nrows, ncols), lambda: sinusoidal_grid(nrows, ncols)
+    else:
+        full = args.area_emb_full
+        key, load = (metadata['grid_emb_path'], full), lambda: load_flat(metadata['grid_emb_path'], full)
+    if args.use_quadtree:
+        tree, load_grid = metadata['quadtree'], load
+        key, load = (key, tree), lambda: tree.embedding_table(load_grid(), nrows, ncols)
+    return shared_area_embedding(key, load)
 
 
 
@@ -224,7 +264,8 @@ from positional_encodings.tf_encodings import TFPositionalEncoding2D, TFSummer
 
 class AMMASI(tf.keras.layers.Layer):
     def __init__(self, args, metadata):
-        super().__init__()
+        # inputs stay float32 under mixed precision: X carries the grid cell / leaf index
+        super().__init__(autocast=False)
         self.args = args
         self.metadata = metadata
         self.model_name = f'AMMASI'
@@ -233,29 +274,29 @@ class AMMASI(tf.keras.layers.Layer):
         self.y_std = metadata['y_std']
         self.D = args.D
         self.K = args.K
-        self.d = args.d
-        self.sigma = args.sigma
-        self.sigma2 = args.sigma2
+        self.num_neighbors = metadata['num_neighbors']
+        # neighbor radii, attention scale and neighbor count, changeable at run time (set_sigma, set_neighbors)
+        self.params = RuntimeParams(sigma=args.sigma, sigma2=args.sigma2, d=args.d, k_active=self.num_neighbors)
         self.max_neighboridx = metadata['max_neighboridx']
-        self.train_features = metadata['Train_features']
+        self.train_features = feature_store(metadata, 'Train_features')   # shared (N, F) variable
         self.ncols = metadata['ncols']
         self.nrows = metadata['nrows']
         self.args = args
 
         
-        if args.use_sinusoidal:
-            p_enc_2d = TFPositionalEncoding2D(64)
-            y = tf.zeros((1,100,100,64))
-            image = p_enc_2d(y).numpy()
-            image = image.squeeze(0)
-            self.grid_emb = image
-        else:
-            self.grid_emb = metadata['grid_emb']
-            print('self.grid_emb', self.grid_emb.shape)
+        if args.use_areaemb:
+            self.area_embedding = area_embedding_for(args, metadata)
 
 
         
     def build(self, input_shape):
+        if self.args.use_areaemb and self.args.train_areaemb:
+            # a trainable copy per model, saved with its weights
+            table = self.area_embedding.table
+            self.grid_emb = self.add_weight(name='grid_emb', shape=table.shape, trainable=True,
+                                            initializer=tf.constant_initializer(table.numpy()))
+            print('self.grid_emb', self.grid_emb.shape)
+
         self.input_layer = Sequential([
                                 layers.Dense(self.D, activation='elu'),
                                 layers.Dense(self.D),
@@ -303,27 +344,182 @@ class AMMASI(tf.keras.layers.Layer):
                                 layers.Dense(self.D, activation='elu'),
                                 layers.Dense(1)])
 
-    def call(self, X, Nidx, Ndist, Eidx, Edist):
+        if self.args.fused_attention or self.args.kv_cache or self.args.graph_attention:
+            # the fused path and the K/V table read the K/V kernels directly, so create them up front
+            for layer in (self.house_emb_layer_k, self.house_emb_layer_v, self.house_emb_layer2_k, self.house_emb_layer2_v):
+                layer.build((None, self.train_features.shape[-1]))
+
+        if self.args.kv_cache or self.args.graph_attention:
+            self.kv_cache = NeighborKVCache([(self.house_emb_layer_k, self.house_emb_layer_v),
+                                             (self.house_emb_layer2_k, self.house_emb_layer2_v)], self.train_features)
+            self.kv_cache.build()
+
+    @property
+    def sigma(self):
+        return self.params.sigma
+
+    @property
+    def sigma2(self):
+        return self.params.sigma2
+
+    @property
+    def d(self):
+        return self.params.d
+
+    def set_sigma(self, sigma=None, sigma2=None, d=None):
+        '''New neighbor radii / attention scale for the following calls, without retracing.'''
+        self.params.set(sigma=sigma, sigma2=sigma2, d=d)
+
+    @property
+    def k_active(self):
+        return tf.cast(self.params.k_active, tf.int32)
+
+    def set_neighbors(self, k=None):
+        '''
+        Attend over the nearest ``k`` neighbor columns of both branches only (all
+        of them for None), e.g. to trade accuracy for latency at inference. The
+        neighbor lists are distance-sorted, so this keeps the k nearest. Takes
+        effect without retracing; the sliced width is dynamic, so it is ignored
+        by models compiled with --jit_compile.
+        '''
+        k = self.num_neighbors if k is None else min(max(int(k), 1), self.num_neighbors)
+        self.params.set(k_active=k)
+
+    def fused_kv_projection(self, idx):
+        '''(batch, 2, N, k/v, D) keys and values of the neighbours ``idx`` (batch, 2, N) of both branches.'''
+        kv = [[self.house_emb_layer_k, self.house_emb_layer_v], [self.house_emb_layer2_k, self.house_emb_layer2_v]]
+        W1 = tf.stack([tf.concat([k.layers[0].kernel, v.layers[0].kernel], -1) for k, v in kv])   # (2, F, 2D)
+        b1 = tf.stack([tf.concat([k.layers[0].bias, v.layers[0].bias], -1) for k, v in kv])       # (2, 2D)
+        W2 = tf.stack([tf.stack([k.layers[1].kernel, v.layers[1].kernel]) for k, v in kv])        # (2, 2, D, D)
+        b2 = tf.stack([tf.stack([k.layers[1].bias, v.layers[1].bias]) for k, v in kv])            # (2, 2, D)
+        activation = self.house_emb_layer_k.layers[0].activation
+
+        feats = tf.cast(self.train_features.gather(idx), W1.dtype)      # (batch, 2, N, F)
+        hidden = activation(tf.einsum('bnkf,nfh->bnkh', feats, W1) + b1[None, :, None, :])
+        hidden = tf.reshape(hidden, tf.concat([tf.shape(hidden)[:3], [2, self.D]], 0))
+        return tf.einsum('bnkcd,ncde->bnkce', hidden, W2) + b2[None, :, None, :, :]
+
+    def fused_neighbor_attention(self, X, Nidx, Ndist, Eidx, Edist, kv_table=None):
+        '''
+        Both attention branches as one batched computation, same weights and
+        result as the two separate pipelines in call(): the neighbour rows of
+        both branches are gathered once, the first K/V layers of both branches
+        run as one (F, 2D) projection per branch, and attention over
+        (branch, head) is evaluated with broadcast masks instead of tiling.
+        '''
+        idx = tf.stack((Nidx, Eidx), 1)                                    # (batch, 2, N)
+        if kv_table is None:
+            kv_emb = self.fused_kv_projection(idx)
+        else:
+            kv_emb = self.kv_cache.gather(kv_table, idx, tf.constant([[0], [1]]))
+            kv_emb = tf.reshape(kv_emb, tf.concat([tf.shape(idx), [2, self.D]], 0))
+
+        heads = tf.concat([tf.shape(kv_emb)[:3], [self.K, self.D // self.K]], 0)
+        k_emb = tf.reshape(kv_emb[..., 0, :], heads)                        # (batch, 2, N, heads, D/heads)
+        v_emb = tf.reshape(kv_emb[..., 1, :], heads)
+        q_emb = tf.stack((self.house_emb_layer_q(X), self.house_emb_layer2_q(X)), 1)
+        q_emb = tf.reshape(q_emb, (-1, 2, self.K, self.D // self.K))       # (batch, 2, heads, D/heads)
+
+        attention = tf.einsum('bnhd,bnkhd->bnhk', q_emb, k_emb)
+        attention /= tf.cast(self.d ** 0.5, attention.dtype)
+        mask = tf.stack((Ndist < self.sigma, Edist < self.sigma2), 1)
+        attention = tf.where(mask[:, :, None, :], attention, -2 ** 15 + 1)
+        attention = tf.nn.softmax(attention, axis = -1)
+        neigh = tf.einsum('bnhk,bnkhd->bnhd', attention, v_emb)
+        neigh = tf.reshape(neigh, (-1, 2, self.D))
+        return self.house_emb_out(neigh[:, 0]), self.house_emb_out2(neigh[:, 1])
+
+    def ragged_branch_attention(self, q_emb, idx, dist, sigma, k_layer, v_layer, branch, kv_table=None):
+        '''
+        One attention branch over the in-radius neighbours only. The (house,
+        neighbour) pairs with dist < sigma are flattened into one ragged list
+        before gathering and projection, and the softmax runs per house as a
+        segment softmax. A house without any in-radius neighbour keeps all of
+        its neighbours at the mask value, i.e. the uniform average the padded
+        path gives it, so the result matches neighbor_attention().
+        '''
+        batch_size = tf.shape(idx)[0]
+        in_radius = dist < sigma
+        keep = tf.logical_or(in_radius, tf.logical_not(tf.reduce_any(in_radius, -1, keepdims=True)))
+        pos = tf.where(keep)                                              # (M, 2) [house, column]
+        rows = pos[:, 0]
+        nbr = tf.gather_nd(idx, pos)                                      # (M,)
+
+        if kv_table is None:
+            feats = self.train_features.gather(nbr)
+            k_emb, v_emb = k_layer(feats), v_layer(feats)                 # (M, D)
+        else:
+            k_emb, v_emb = tf.split(self.kv_cache.gather(kv_table, nbr, branch), 2, axis = -1)
+        k_emb = tf.reshape(k_emb, (-1, self.K, self.D // self.K))         # (M, heads, D/heads)
+        v_emb = tf.reshape(v_emb, (-1, self.K, self.D // self.K))
+        q_emb = tf.reshape(tf.gather(q_emb, rows), (-1, self.K, self.D // self.K))
+
+        attention = tf.reduce_sum(q_emb * k_emb, -1) / tf.cast(self.d ** 0.5, q_emb.dtype)   # (M, heads)
+        attention = tf.where(tf.gather_nd(in_radius, pos)[:, None], attention, -2 ** 15 + 1)
+        attention = tf.exp(attention - tf.gather(tf.math.unsorted_segment_max(attention, rows, batch_size), rows))
+        attention /= tf.gather(tf.math.unsorted_segment_sum(attention, rows, batch_size), rows)
+
+        neigh_emb = tf.math.unsorted_segment_sum(attention[:, :, None] * v_emb, rows, batch_size)
+        return tf.reshape(neigh_emb, (-1, self.D))
+
+    def ragged_neighbor_attention(self, X, Nidx, Ndist, Eidx, Edist, kv_table=None):
+        neigh_emb = self.ragged_branch_attention(self.house_emb_layer_q(X), Nidx, Ndist, self.sigma,
+                                                 self.house_emb_layer_k, self.house_emb_layer_v, 0, kv_table)
+        neigh_emb2 = self.ragged_branch_attention(self.house_emb_layer2_q(X), Eidx, Edist, self.sigma2,
+                                                  self.house_emb_layer2_k, self.house_emb_layer2_v, 1, kv_table)
+        return self.house_emb_out(neigh_emb), self.house_emb_out2(neigh_emb2)
+
+    def call(self, X, Nidx, Ndist, Eidx, Edist, training=None):
         batch_size = tf.shape(X)[0]
 
+        if not self.args.jit_compile:
+            # nearest k_active neighbor columns (set_neighbors), XLA needs static widths
+            k = self.k_active
+            Nidx, Ndist, Eidx, Edist = Nidx[:, :k], Ndist[:, :k], Eidx[:, :k], Edist[:, :k]
+
         X_ij = X[:, :2]
         X_idx = tf.cast(X_ij[:, 0] + X_ij[:, 1] * self.ncols, tf.int32)
 
         X = self.input_layer(X[:, 2:])
 
         if self.args.use_areaemb:
-            grid_emb = tf.expand_dims(self.grid_emb, 0)
-            grid_emb = tf.squeeze(grid_emb, 0)
-            grid_emb = tf.reshape(grid_emb, (grid_emb.shape[0]*grid_emb.shape[1], -1))
-            grid_emb = tf.gather(grid_emb, X_idx)
+            # X_idx is the grid cell or quadtree leaf id
+            table = self.grid_emb if self.args.train_areaemb else self.area_embedding.table
+            grid_emb = tf.cast(tf.gather(table, X_idx), self.compute_dtype)
+
+
+        kv_table = None
+        if (self.args.kv_cache or self.args.graph_attention) and training is False:
+            # inference: neighbours' keys/values come from the precomputed table
+            kv_table = self.kv_cache.lookup()
+        elif self.args.graph_attention:
+            # full-batch training step: every training house projected once, the neighbor lists gather from it
+            kv_table = self.kv_cache.project()
+
+        if self.args.ragged_attention or self.args.graph_attention:
+            neigh_emb, neigh_emb2 = self.ragged_neighbor_attention(X, Nidx, Ndist, Eidx, Edist, kv_table)
+        elif self.args.fused_attention:
+            neigh_emb, neigh_emb2 = self.fused_neighbor_attention(X, Nidx, Ndist, Eidx, Edist, kv_table)
+        else:
+            neigh_emb, neigh_emb2 = self.neighbor_attention(X, Nidx, Ndist, Eidx, Edist, kv_table)
 
+        if self.args.use_areaemb:
+            output = self.output_layer(tf.concat((X, neigh_emb, neigh_emb2, grid_emb), -1))
+        else:
+            output = self.output_layer(tf.concat((X, neigh_emb, neigh_emb2), -1))
 
+        # de-normalise in float32, 16 bit cannot resolve the log price around its mean
+        return tf.cast(output, tf.float32) * self.y_std + self.y_mean
 
+    def neighbor_attention(self, X, Nidx, Ndist, Eidx, Edist, kv_table=None):
         ################
         q_emb = self.house_emb_layer_q(X)  # (batch, D)
         q_emb = tf.expand_dims(q_emb, 1)   # (batch, 1, D)
-        k_emb = self.house_emb_layer_k(tf.gather(self.train_features, Nidx)) # (batch, 60, D)
-        v_emb = self.house_emb_layer_v(tf.gather(self.train_features, Nidx)) # (batch, 60, D)
+        if kv_table is None:
+            k_emb = self.house_emb_layer_k(self.train_features.gather(Nidx)) # (batch, 60, D)
+            v_emb = self.house_emb_layer_v(self.train_features.gather(Nidx)) # (batch, 60, D)
+        else:
+            k_emb, v_emb = tf.split(self.kv_cache.gather(kv_table, Nidx, 0), 2, axis = -1)
 
         q_emb = tf.concat(tf.split(q_emb, self.K, axis = -1), axis = 0)
         k_emb = tf.concat(tf.split(k_emb, self.K, axis = -1), axis = 0)
@@ -331,7 +527,7 @@ class AMMASI(tf.keras.layers.Layer):
 
         k_emb = tf.transpose(k_emb, perm = (0, 2, 1))
         attention = tf.matmul(q_emb, k_emb)
-        attention /= (self.d ** 0.5)
+        attention /= tf.cast(self.d ** 0.5, attention.dtype)
 
         mask = Ndist < self.sigma
         mask = tf.expand_dims(mask, 1)
@@ -351,8 +547,11 @@ class AMMASI(tf.keras.layers.Layer):
         ################
         q_emb = self.house_emb_layer2_q(X)  # (batch, D)
         q_emb = tf.expand_dims(q_emb, 1)   # (batch, 1, D)
-        k_emb = self.house_emb_layer2_k(tf.gather(self.train_features, Eidx)) # (batch, 60, D)
-        v_emb = self.house_emb_layer2_v(tf.gather(self.train_features, Eidx)) # (batch, 60, D)
+        if kv_table is None:
+            k_emb = self.house_emb_layer2_k(self.train_features.gather(Eidx)) # (batch, 60, D)
+            v_emb = self.house_emb_layer2_v(self.train_features.gather(Eidx)) # (batch, 60, D)
+        else:
+            k_emb, v_emb = tf.split(self.kv_cache.gather(kv_table, Eidx, 1), 2, axis = -1)
 
         q_emb = tf.concat(tf.split(q_emb, self.K, axis = -1), axis = 0)
         k_emb = tf.concat(tf.split(k_emb, self.K, axis = -1), axis = 0)
@@ -360,7 +559,7 @@ class AMMASI(tf.keras.layers.Layer):
 
         k_emb = tf.transpose(k_emb, perm = (0, 2, 1))
         attention = tf.matmul(q_emb, k_emb)
-        attention /= (self.d ** 0.5)
+        attention /= tf.cast(self.d ** 0.5, attention.dtype)
 
         mask = Edist < self.sigma2
         mask = tf.expand_dims(mask, 1)
@@ -376,13 +575,7 @@ class AMMASI(tf.keras.layers.Layer):
         neigh_emb2 = tf.concat(tf.split(neigh_emb2, self.K, axis = 0), axis = -1)
         neigh_emb2 = self.house_emb_out2(neigh_emb2)
 
-
-        if self.args.use_areaemb:
-            output = self.output_layer(tf.concat((X, neigh_emb, neigh_emb2, grid_emb), -1))
-        else:
-            output = self.output_layer(tf.concat((X, neigh_emb, neigh_emb2), -1))
-
-        return output * self.y_std + self.y_mean
+        return neigh_emb, neigh_emb2
     
 
     
\ No newline at end of file
@@ -0,0 +1,76 @@
+import weakref
+import numpy as np
+import tensorflow as tf
+
+
+_stores = {}
+
+
+class FeatureStore:
+    '''
+    Reference table of the training houses (Train_features, X_ref, y_ref, ...)
+    held once as a non-trainable resource variable instead of a constant
+    captured by every traced graph. The source may be an array or a
+    memory-mapped buffer; it is read when the table is first used.
+
+    The number of rows is left unknown to the graph, so update() can overwrite
+    rows or swap in a table of a different size in place and traced functions
+    gather from the new values without retracing. ``version`` counts updates,
+    for caches derived from the table (NeighborKVCache).
+    '''
+    def __init__(self, values, dtype=tf.float32, name='features'):
+        self.values = values
+        self.dtype = tf.as_dtype(dtype)
+        self.name = name
+        self._table = None
+
+    def _materialize(self):
+        values = np.asarray(self.values)
+        with tf.init_scope():
+            self._table = tf.Variable(tf.cast(values, self.dtype), trainable=False, name=self.name,
+                                      shape=tf.TensorShape([None]).concatenate(values.shape[1:]))
+            self._version = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.values = None
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._materialize()
+        return self._table
+
+    @property
+    def version(self):
+        self.table
+        return self._version
+
+    @property
+    def shape(self):
+        return tuple(self.table.shape)
+
+    def gather(self, idx):
+        return tf.gather(self.table, idx)
+
+    def update(self, values, rows=None):
+        '''Replace the whole table (any number of rows), or only ``rows`` with ``values``.'''
+        values = tf.cast(values, self.dtype)
+        if rows is None:
+            self.table.assign(values)
+        else:
+            self.table.scatter_nd_update(tf.reshape(rows, (-1, 1)), values)
+        self._version.assign_add(1)
+
+
+def feature_store(metadata, name, dtype=tf.float32):
+    '''
+    The FeatureStore of ``metadata[name]``, created on first request. Stores are
+    keyed by the source array (metadata itself is tracked by the layers and
+    must not change under them), so every model class and instance built from
+    the same metadata shares one table.
+    '''
+    for key in [key for key, (ref, _) in _stores.items() if ref() is None]:
+        del _stores[key]
+    values = metadata[name]
+    key = (id(values), name, tf.as_dtype(dtype).name)
+    if key not in _stores or _stores[key][0]() is not values:
+        _stores[key] = (weakref.ref(values), FeatureStore(values, dtype, name))
+    return _stores[key][1]
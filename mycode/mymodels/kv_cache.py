@@ -0,0 +1,70 @@
+import tensorflow as tf
+
+
+class NeighborKVCache:
+    '''
+    Key/value projections of every training house, for inference.
+
+    The neighbour K/V MLPs only ever see rows of Train_features, so at inference
+    all N houses can be projected once per branch and queries gather finished
+    (D,) rows instead of re-running the MLPs on every gathered neighbour.
+
+    Layout: one (branches * N, 2D) table, row ``b * N + i`` holds [key | value]
+    of house i for branch b. The table is derived state, so it is kept off the
+    layer's weights (and checkpoints); a copy of the K/V weights and the feature
+    store version it was built from are kept next to it and the table is rebuilt
+    inside the graph whenever they differ, e.g. after a training epoch,
+    load_weights or a feature store update.
+
+    Graph attention (--graph_attention, full-batch training) builds the same
+    table with project() on every training step, so each house is projected
+    once per step however many rows it is a neighbour of; at inference it
+    reads the table through lookup() like --kv_cache.
+    '''
+    def __init__(self, branches, store):
+        self.branches = branches    # [(key_mlp, value_mlp), ...], already built
+        self.store = store          # FeatureStore of Train_features
+
+    @property
+    def source_weights(self):
+        return [w for mlps in self.branches for mlp in mlps for w in mlp.weights]
+
+    @property
+    def num_houses(self):
+        return tf.shape(self.store.table)[0]
+
+    def build(self):
+        width = sum(mlp.layers[-1].units for mlp in self.branches[0])
+        # table and snapshot in the compute dtype: under mixed precision the table
+        # is a function of the 16 bit weights the MLPs actually run with
+        self.dtype = self.branches[0][0].compute_dtype
+        with tf.init_scope():
+            # sized for the current store: XLA cannot assign a table of another shape
+            rows = len(self.branches) * int(self.num_houses)
+            self.table = tf.Variable(tf.zeros((rows, width), self.dtype), trainable=False, shape=(None, width))
+            self.snapshot = [tf.Variable(tf.zeros(w.shape, self.dtype), trainable=False) for w in self.source_weights]
+            self.store_version = tf.Variable(-1, dtype=tf.int64, trainable=False)
+
+    def project(self):
+        '''The table from the current weights and features, differentiable: graph attention trains through it.'''
+        features = tf.cast(self.store.table, self.dtype)
+        return tf.concat([tf.concat([k(features), v(features)], -1) for k, v in self.branches], 0)
+
+    def refresh(self):
+        table = self.project()
+        self.table.assign(table)
+        for s, w in zip(self.snapshot, self.source_weights):
+            s.assign(tf.cast(w, self.dtype))
+        self.store_version.assign(self.store.version)
+        return table
+
+    def lookup(self):
+        '''The current table, rebuilt first if the K/V weights or the features changed since it was made.'''
+        stale = tf.not_equal(self.store_version, self.store.version)
+        for s, w in zip(self.snapshot, self.source_weights):
+            stale = tf.logical_or(stale, tf.reduce_any(tf.not_equal(s, tf.cast(w, self.dtype))))
+        return tf.cond(stale, self.refresh, self.table.read_value)
+
+    def gather(self, table, idx, branch):
+        '''(..., 2D) [key | value] rows of houses ``idx`` for ``branch``.'''
+        return tf.gather(table, idx + branch * self.num_houses)
@@ -3,6 +3,7 @@ import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import *
 from mymodels.basic import *
+from mymodels.feature_store import feature_store
 
     
 class MyNeighborMean(tf.keras.layers.Layer):
@@ -14,8 +15,8 @@ class MyNeighborMean(tf.keras.layers.Layer):
         self.num_features = metadata['num_features']
         self.num_neighbors = metadata['num_neighbors']
         self.categories = metadata['categories']
-        self.X_ref = tf.convert_to_tensor(metadata['X_ref'], dtype=tf.float32)
-        self.y_ref = tf.convert_to_tensor(metadata['y_ref'], dtype=tf.float32)
+        self.X_ref = feature_store(metadata, 'X_ref')
+        self.y_ref = feature_store(metadata, 'y_ref')
         self.D = args.D
         
     def build(self, input_shape):
@@ -34,7 +35,7 @@ class MyNeighborMean(tf.keras.layers.Layer):
         
         S_count = tf.reduce_sum(tf.cast(S >= 0, dtype=tf.float32), -1) + 1
         S_count = tf.expand_dims(S_count, 1)
-        y_near = tf.expand_dims(tf.gather(self.y_ref, S, axis=0), -1)
+        y_near = tf.expand_dims(self.y_ref.gather(S), -1)
         y_near = tf.reduce_sum(y_near, 1) / S_count
         
         X_emb = tf.concat((X_emb, y_near), -1) #tf.concat((X_emb, X_near), -1)
@@ -87,8 +88,8 @@ class MyBasicNeighbor(tf.keras.layers.Layer):
         self.num_features = metadata['num_features']
         self.num_neighbors = metadata['num_neighbors']
         self.categories = metadata['categories']
-        self.X_ref = tf.convert_to_tensor(metadata['X_ref'], dtype=tf.float32)
-        self.y_ref = tf.convert_to_tensor(metadata['y_ref'], dtype=tf.float32)
+        self.X_ref = feature_store(metadata, 'X_ref')
+        self.y_ref = feature_store(metadata, 'y_ref')
         self.D = args.D
         
     def build(self, input_shape):
@@ -107,8 +108,8 @@ class MyBasicNeighbor(tf.keras.layers.Layer):
         
         S_count = tf.reduce_sum(tf.cast(S >= 0, dtype=tf.float32), -1) + 1
         S_count = tf.expand_dims(S_count, 1)
-        X_near = tf.gather(self.X_ref, S, axis=0)
-        y_near = tf.expand_dims(tf.gather(self.y_ref, S, axis=0), -1)
+        X_near = self.X_ref.gather(S)
+        y_near = tf.expand_dims(self.y_ref.gather(S), -1)
         X_near = tf.concat((X_near, y_near), -1)
         X_near = tf.reshape(X_near, (-1, X_near.shape[-1]))
         X_near = self.neighbor_basic_emb_layer(X_near)
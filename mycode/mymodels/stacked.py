@@ -0,0 +1,127 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+from mymodels.basic import area_embedding_for
+from mymodels.feature_store import feature_store
+
+
+class StackedDense(layers.Layer):
+    '''
+    ``variants`` independent Dense layers stacked along a leading axis: kernel
+    (V, in, units), bias (V, units). The input is (V, ..., in), or (..., in)
+    with ``shared=True`` when every variant sees the same tensor (the house
+    features, gathered neighbour rows); the output is (V, ..., units).
+    ``tail`` (..., in_tail) are shared input features that follow those of x:
+    they meet the last in_tail kernel rows without being copied per variant.
+    Build the layer with the full input width first when using it.
+    '''
+    def __init__(self, variants, units, activation=None):
+        super().__init__()
+        self.variants = variants
+        self.units = units
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        fan_in = int(input_shape[-1])
+        limit = np.sqrt(6. / (fan_in + self.units))   # glorot_uniform of one (in, units) slice, as Dense
+        self.kernel = self.add_weight(name='kernel', shape=(self.variants, fan_in, self.units), trainable=True,
+                                      initializer=tf.keras.initializers.RandomUniform(-limit, limit))
+        self.bias = self.add_weight(name='bias', shape=(self.variants, self.units), trainable=True,
+                                    initializer='zeros')
+        super().build(input_shape)
+
+    def call(self, x, shared=False, tail=None):
+        # rows flattened to (n, in) or (V, n, in); a shared input meets every variant's kernel in one einsum
+        rows = tf.shape(x)[:-1] if shared else tf.shape(x)[1:-1]
+        kernel = self.kernel
+        if tail is not None:
+            kernel, tail_kernel = kernel[:, :-tail.shape[-1]], kernel[:, -tail.shape[-1]:]
+        if shared:
+            y = tf.einsum('nf,vfu->vnu', tf.reshape(x, (-1, tf.shape(x)[-1])), kernel)
+        else:
+            y = tf.matmul(tf.reshape(x, (self.variants, -1, tf.shape(x)[-1])), kernel)
+        if tail is not None:
+            y += tf.einsum('nf,vfu->vnu', tf.reshape(tail, (-1, tail.shape[-1])), tail_kernel)
+        y = self.activation(y + self.bias[:, None, :])
+        return tf.reshape(y, tf.concat([[self.variants], rows, [self.units]], 0))
+
+
+class StackedMLP(layers.Layer):
+    '''Dense(units[0], activation) -> ... -> Dense(units[-1]), per variant.'''
+    def __init__(self, variants, units, activation='elu'):
+        super().__init__()
+        self.dense = [StackedDense(variants, u, activation if i < len(units) - 1 else None) for i, u in enumerate(units)]
+
+    def call(self, x, shared=False, tail=None):
+        x = self.dense[0](x, shared=shared, tail=tail)
+        for layer in self.dense[1:]:
+            x = layer(x)
+        return x
+
+
+class StackedAMMASI(tf.keras.layers.Layer):
+    '''
+    len(sigmas) independent AMMASI models in one layer, e.g. the points of a
+    sigma / sigma2 sweep. Every weight carries a leading variant axis; the
+    variants share the inputs, the area embedding lookup and the neighbour
+    rows gathered from Train_features, and differ in their weights and their
+    neighbour radii. Returns (V, batch, 1) predictions.
+    '''
+    def __init__(self, args, metadata, sigmas, sigma2s):
+        super().__init__()
+        self.args = args
+        self.model_name = f'StackedAMMASI'
+        self.y_mean = metadata['y_mean']
+        self.y_std = metadata['y_std']
+        self.D = args.D
+        self.K = args.K
+        self.d = args.d
+        self.variants = len(sigmas)
+        self.sigmas = tf.constant(sigmas, tf.float32)
+        self.sigma2s = tf.constant(sigma2s, tf.float32)
+        self.train_features = feature_store(metadata, 'Train_features')
+        self.ncols = metadata['ncols']
+        if args.use_areaemb:
+            self.area_embedding = area_embedding_for(args, metadata)
+
+    def build(self, input_shape):
+        mlp = lambda units: StackedMLP(self.variants, units)
+        self.input_layer = mlp([self.D, self.D])
+        # Geographical Neighbor House Attention
+        self.house_emb_layer_q, self.house_emb_layer_k = mlp([self.D, self.D]), mlp([self.D, self.D])
+        self.house_emb_layer_v, self.house_emb_out = mlp([self.D, self.D]), mlp([self.D, self.D])
+        # Euclidian Similar House Attention
+        self.house_emb_layer2_q, self.house_emb_layer2_k = mlp([self.D, self.D]), mlp([self.D, self.D])
+        self.house_emb_layer2_v, self.house_emb_out2 = mlp([self.D, self.D]), mlp([self.D, self.D])
+        self.output_layer = mlp([self.D, 1])
+        if self.args.use_areaemb:
+            # the area embedding enters as a shared tail of the output input (see call)
+            self.output_layer.dense[0].build((None, 3 * self.D + self.area_embedding.shape[1]))
+
+    def branch_attention(self, X, idx, dist, sigmas, q_layer, k_layer, v_layer, out_layer):
+        batch_size, num_neighbors = tf.shape(idx)[0], tf.shape(idx)[1]
+        feats = self.train_features.gather(idx)                           # (batch, N, F), gathered once for all variants
+        q_emb = tf.reshape(q_layer(X), (self.variants, batch_size, self.K, self.D // self.K))
+        kv_heads = (self.variants, batch_size, num_neighbors, self.K, self.D // self.K)
+        k_emb = tf.reshape(k_layer(feats, shared=True), kv_heads)         # (V, batch, N, heads, D/heads)
+        v_emb = tf.reshape(v_layer(feats, shared=True), kv_heads)
+
+        attention = tf.einsum('vbhd,vbnhd->vbhn', q_emb, k_emb) / self.d ** 0.5
+        mask = dist[None] < sigmas[:, None, None]                          # (V, batch, N)
+        attention = tf.where(mask[:, :, None, :], attention, -2 ** 15 + 1)
+        attention = tf.nn.softmax(attention, axis = -1)
+        neigh_emb = tf.einsum('vbhn,vbnhd->vbhd', attention, v_emb)
+        return out_layer(tf.reshape(neigh_emb, (self.variants, -1, self.D)))
+
+    def call(self, X, Nidx, Ndist, Eidx, Edist):
+        X_idx = tf.cast(X[:, 0] + X[:, 1] * self.ncols, tf.int32)
+        X = self.input_layer(X[:, 2:], shared=True)                       # (V, batch, D)
+
+        neigh_emb = self.branch_attention(X, Nidx, Ndist, self.sigmas, self.house_emb_layer_q,
+                                          self.house_emb_layer_k, self.house_emb_layer_v, self.house_emb_out)
+        neigh_emb2 = self.branch_attention(X, Eidx, Edist, self.sigma2s, self.house_emb_layer2_q,
+                                           self.house_emb_layer2_k, self.house_emb_layer2_v, self.house_emb_out2)
+        # the area embedding row is the same for every variant: a shared tail instead of V copies
+        grid_emb = tf.gather(self.area_embedding.table, X_idx) if self.args.use_areaemb else None
+        output = self.output_layer(tf.concat([X, neigh_emb, neigh_emb2], -1), tail=grid_emb)
+        return output * self.y_std + self.y_mean
@@ -1,61 +1,169 @@
+'''
+Runs the commands of run_subprocess_list.sh on a fixed set of worker slots.
+Every slot owns ``--cores`` CPU cores (the task is pinned to them and its
+OpenMP/TF thread pools are sized to match) and ``--mem`` GB of the memory
+budget, so the number of slots is what the machine holds without
+oversubscription. Slots are CPU-only by default; with ``--gpus 0,1,2,3``
+every slot also gets one GPU (CUDA_VISIBLE_DEVICES). Tasks come from one
+queue; a failed task is queued again up to ``--retries`` times. With
+``--resume_on_retry`` every attempt saves its training state each epoch
+(--state_every 1, unless the task sets --state_every itself) and retries
+continue from it with --restore_model. Exit code, wall time and peak RSS of
+every attempt go to the log and to a JSON summary.
+
+    python run_subprocess.py --cores 4 --mem 8 --retries 1 --resume_on_retry
+'''
+
 import threading
 import time
 import logging
 import os
+import sys
+import json
+import queue
+import shlex
+import argparse
 import subprocess
 from datetime import datetime
 logging.basicConfig(filename="run_subprocess.log", filemode='w',
                     level=logging.DEBUG,
                     format='(%(threadName)-9s) %(message)s',)
 
-gpu_list = [0, 1, 2, 3]
-total_trials = 1
 
-def wait_for_task(e, gpu, message):
-    logging.debug('wait_for_task starting')
-    time.sleep(5)
+def available_memory_gb():
+    with open('/proc/meminfo') as f:
+        info = dict(line.split(':', 1) for line in f)
+    return int(info['MemAvailable'].split()[0]) / 2 ** 20
+
+
+def make_slots(cores_per_task, mem_per_task, total_mem, gpus):
+    '''[(cores, gpu), ...]: disjoint core sets, as many as both the cores and the memory budget allow.'''
+    cores = sorted(os.sched_getaffinity(0))
+    num_slots = len(cores) // cores_per_task
+    if mem_per_task > 0:
+        num_slots = min(num_slots, int(total_mem // mem_per_task))
+    if gpus:
+        num_slots = min(num_slots, len(gpus))
+    if num_slots < 1:
+        sys.exit(f'not enough cores ({len(cores)}) or memory ({total_mem:.1f} GB) for one task')
+    return [(cores[i * cores_per_task:(i + 1) * cores_per_task], gpus[i] if gpus else '') for i in range(num_slots)]
+
+
+def task_env(cores, gpu):
+    env = dict(os.environ)
+    threads = str(len(cores))
+    env.update(OMP_NUM_THREADS=threads, MKL_NUM_THREADS=threads, OPENBLAS_NUM_THREADS=threads,
+               TF_NUM_INTRAOP_THREADS=threads, TF_NUM_INTEROP_THREADS=str(min(2, len(cores))))
+    if gpu != '':   # no --gpus: the devices of the environment
+        env['CUDA_VISIBLE_DEVICES'] = str(gpu)
+    return env
+
+
+def run_task(task, cores, gpu, log_path):
+    '''Runs one command pinned to ``cores``; returns (exit code, wall seconds, peak RSS in MB).'''
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        try:
+            proc = subprocess.Popen(shlex.split(task), stdout=log, stderr=subprocess.STDOUT, env=task_env(cores, gpu))
+        except OSError as e:
+            log.write(f'{e}\n')
+            return 127, time.perf_counter() - start, 0.
+        # pinned from here rather than with preexec_fn, which can deadlock the child when the
+        # scheduler threads fork at the same time; threads the task starts later inherit it
+        try:
+            os.sched_setaffinity(proc.pid, cores)
+        except ProcessLookupError:
+            pass    # already exited
+        # wait4 instead of proc.wait(): the child's resource usage comes with its exit status
+        _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, time.perf_counter() - start, usage.ru_maxrss / 1024
 
-    while not e.isSet():
-        if len(message) > 0:
-            start_time = datetime.now() 
-            task, trial = message.pop(0)
-            n_task = f'CUDA_VISIBLE_DEVICES={gpu} ' + task
-            logging.debug(f'({trial}/{(len(message)+1)}) ' + n_task)
-            os.system(n_task)
-            time_elapsed = datetime.now() - start_time 
-            if time_elapsed.seconds > 60:
-                print(f'Starting ({trial}/{(len(message)+1)}) ' + n_task)
-        time.sleep(1)
+
+def task_command(task, attempt, resume_on_retry):
+    '''Command line of one attempt of ``task``.'''
+    if not resume_on_retry:
+        return task
+    if not any(a == '--state_every' or a.startswith('--state_every=') for a in shlex.split(task)):
+        task += ' --state_every 1'  # nothing to resume from otherwise
+    return task + ' --restore_model' if attempt > 0 else task
+
+
+def worker(tasks, slot, args, results, lock):
+    cores, gpu = slot
+    while True:
+        item = tasks.get()
+        if item is None:
+            tasks.task_done()
+            return
+        index, task, trial, attempt = item
+        command = task_command(task, attempt, args.resume_on_retry)
+        log_path = os.path.join(args.log_dir, f'{index:04d}_{trial}_{attempt}.log')
+        logging.debug(f'({index}/{trial}/{attempt}) cores {cores} gpu {gpu!r}: {command}')
+        returncode, wall_time, max_rss = run_task(command, cores, gpu, log_path)
+        logging.debug(f'({index}/{trial}/{attempt}) exit {returncode}, {wall_time:.1f}s, {max_rss:.0f} MB')
+        with lock:
+            results.append(dict(index=index, trial=trial, attempt=attempt, task=command, cores=cores, gpu=gpu,
+                                returncode=returncode, wall_time=wall_time, max_rss_mb=max_rss, log=log_path))
+            print(f'[{datetime.now():%H:%M:%S}] ({len(results)}) exit {returncode} {wall_time:.0f}s {max_rss:.0f}MB: {command}')
+        if returncode != 0 and attempt < args.retries:
+            tasks.put((index, task, trial, attempt + 1))
+        tasks.task_done()
 
 
 if __name__ == '__main__':
-    e = threading.Event()
+    parser = argparse.ArgumentParser(description='parameter')
+    parser.add_argument('--list', type=str, default='run_subprocess_list.sh')
+    parser.add_argument('--cores', type=int, default=4) # CPU cores per task
+    parser.add_argument('--mem', type=float, default=0) # GB reserved per task, 0: no memory limit on the slots
+    parser.add_argument('--total_mem', type=float, default=None) # GB to schedule, default the available memory
+    parser.add_argument('--gpus', type=str, default='') # comma separated, one slot per GPU; empty: CPU-only slots, no CUDA_VISIBLE_DEVICES per task
+    parser.add_argument('--trials', type=int, default=1)
+    parser.add_argument('--retries', type=int, default=0) # extra attempts of a failed task
+    parser.add_argument('--resume_on_retry', action='store_true') # save the training state every epoch, retry with --restore_model
+    parser.add_argument('--log_dir', type=str, default='run_subprocess_logs') # output of every attempt
+    parser.add_argument('--summary', type=str, default='run_subprocess_summary.json')
+    args = parser.parse_args()
 
     logging.debug('reading process list')
     tasks = []
-    with open('run_subprocess_list.sh') as fp:
+    with open(args.list) as fp:
         for line in fp:
             line = line.strip()
             if len(line) > 0 and line[0] != '#':
                 tasks.append(line)
-        # tasks = [_.strip() for _ in fp]
-    
-    
-    thread_list = {}
-    message = []
-    for n in gpu_list:
-        t = threading.Thread(name=f'blocking_{n}', 
-                        target=wait_for_task,
-                        args=(e, n, message,))
-        thread_list[n] = t
-        t.start()
 
-    for trial in range(total_trials):
-        for task in tasks:
-            message.append((task, trial))
+    total_mem = args.total_mem if args.total_mem is not None else available_memory_gb()
+    slots = make_slots(args.cores, args.mem, total_mem, [g for g in args.gpus.split(',') if g])
+    os.makedirs(args.log_dir, exist_ok=True)
+    logging.debug(f'{len(slots)} slots: {slots}')
+    print(f'{len(tasks) * args.trials} tasks on {len(slots)} slots of {args.cores} cores')
+
+    task_queue = queue.Queue()
+    for trial in range(args.trials):
+        for index, task in enumerate(tasks):
+            task_queue.put((index, task, trial, 0))
+
+    results, lock = [], threading.Lock()
+    start = time.perf_counter()
+    thread_list = [threading.Thread(name=f'slot_{n}', target=worker, args=(task_queue, slot, args, results, lock))
+                   for n, slot in enumerate(slots)]
+    for t in thread_list:
+        t.start()
+    task_queue.join()    # retries are queued before task_done, so this waits for them too
+    for _ in thread_list:
+        task_queue.put(None)
+    for t in thread_list:
+        t.join()
 
-    for n in gpu_list:
-        thread_list[n].join()
+    final = {}
+    for r in results:
+        final[(r['index'], r['trial'])] = r     # last attempt of every task
+    failed = [r for r in final.values() if r['returncode'] != 0]
+    summary = dict(tasks=len(final), failed=len(failed), attempts=len(results), slots=len(slots),
+                   cores_per_task=args.cores, mem_per_task=args.mem, wall_time=time.perf_counter() - start,
+                   results=sorted(results, key=lambda r: (r['index'], r['trial'], r['attempt'])))
+    with open(args.summary, 'w') as f:
+        json.dump(summary, f, indent=1)
 
-    print(f'run_subprocess.py over with {len(tasks)} tasks')
-    e.set()
\ No newline at end of file
+    print(f'run_subprocess.py over with {len(final)} tasks, {len(failed)} failed, {summary["wall_time"]:.0f}s; summary in {args.summary}')
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Sweep over neighbor radii in one process. The data is loaded and the model is
+built, compiled and traced once. For every (sigma, sigma2) pair the weights go
+back to the same initial values, the optimizer state is cleared, the new radii
+are set on the layer and the model is trained and tested again:
+
+    python sigma_sweep.py --dataset fc --use_areaemb --use_poiprox --sigmas 0.01,0.02,0.05 --sigma2s 0.02
+
+replaces one train_addr.py process per point of run_subprocess_list.sh.
+'''
+
+import os
+import time
+import logging
+import itertools
+from tensorflow import keras
+import utils
+from train_addr import get_parser, model_define, compile_model, fit_data, predict_metric, reset_training_state, attention_layer
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument('--sigmas', type=utils.float_list, default=None) # comma separated, default --sigma
+    parser.add_argument('--sigma2s', type=utils.float_list, default=None) # comma separated, default --sigma2
+    args = parser.parse_args()
+    sigmas = args.sigmas or [args.sigma]
+    sigma2s = args.sigma2s or [args.sigma2]
+
+    utils.set_precision(args.precision)
+    if args.jit_compile:
+        utils.enable_compilation_cache(args.xla_cache_dir)
+    if not os.path.isdir(f'test_logs/{args.dataset}'):
+        os.makedirs(f'test_logs/{args.dataset}')
+
+    # pruned neighbor columns have to cover the widest radius of the sweep
+    args.sigma, args.sigma2 = max(sigmas), max(sigma2s)
+    dataset, metadata = utils.dataloader.load_data_ours(args)
+    X_train, Nidx_train, Ndist_train, Eidx_train, Edist_train, y_train, \
+            X_test , Nidx_test , Ndist_test , Eidx_test, Edist_test, y_test = dataset
+    train_inputs = (X_train, Nidx_train, Ndist_train, Eidx_train, Edist_train)
+    test_inputs = (X_test, Nidx_test, Ndist_test, Eidx_test, Edist_test)
+
+    model, model_name = model_define(args, metadata)
+    compile_model(model, args)
+    layer = attention_layer(model)
+    initial_weights = model.get_weights()
+
+    logging.basicConfig(filename=f'./test_logs/{args.dataset}/{args.dataset}_{model_name}_sigma_sweep.log', level=logging.INFO, format='%(asctime)s - %(message)s', filemode='w')
+    logging.info(str(args))
+
+    results = []
+    for sigma, sigma2 in itertools.product(sigmas, sigma2s):
+        reset_training_state(model, initial_weights, args)
+        layer.set_sigma(sigma, sigma2)
+
+        best_weights = utils.BestWeights(monitor='val_loss')
+        callbacks = [keras.callbacks.EarlyStopping(monitor="val_loss", patience=args.patience_stop),
+                     keras.callbacks.ReduceLROnPlateau(monitor="val_loss", patience=args.patience_lr),
+                     best_weights]
+        start = time.perf_counter()
+        model.fit(**fit_data(args, train_inputs, y_train), epochs=args.max_epoch, verbose=0, callbacks=callbacks)
+        _, metric = predict_metric(model, args, test_inputs, y_test)
+        elapsed = time.perf_counter() - start
+
+        results.append((sigma, sigma2, best_weights.best_epoch, elapsed) + tuple(metric))
+        print(f'sigma {sigma} sigma2 {sigma2}: best epoch {best_weights.best_epoch + 1}, {elapsed:.1f}s', args.dataset, metric)
+        logging.info(f'Test: \t{model_name} \t {args.dataset} \t sigma {sigma} \t sigma2 {sigma2} \t {metric}')
+
+    print(f'{"sigma":>8}{"sigma2":>8}{"epoch":>7}{"time(s)":>9}{"MALE":>9}{"RMSE":>12}{"MAPE":>9}')
+    for sigma, sigma2, epoch, elapsed, male, rmse, mape in results:
+        print(f'{sigma:>8}{sigma2:>8}{epoch + 1:>7}{elapsed:>9.1f}{male:>9.4f}{rmse:>12.1f}{mape:>9.4f}')
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Hyperparameter sweep over the options of train_addr.py without a process per
+run. Every ``--space`` entry is a train_addr option with the values to try;
+the sweep is their full grid, or ``--samples`` random draws from it (a
+``low:high`` range is drawn log-uniformly when low > 0, uniformly otherwise):
+
+    python sweep.py --use_areaemb --use_poiprox --space dataset=fc,kc --space sigma=0.01,0.02,0.05 --workers 2
+    python sweep.py --dataset fc --use_areaemb --use_poiprox --space learning_rate=0.001:0.01 --space D=32,64 --samples 8
+
+The options not swept come from the command line as in train_addr.py. Every
+dataset the sweep needs (one per combination of the options load_data_ours
+reads) is loaded once by the parent and saved as .npy files; the spawned
+workers memory-map them, so all of them read the same pages, and keep them
+for the trials that follow. A trial then only builds, trains and tests its
+model. Results go to ``--results`` (one JSON line per trial, as they finish)
+and predictions to prediction/{dataset}/{name}_sweep_{trial}.npy.
+'''
+
+import os
+import time
+import json
+import pickle
+import random
+import signal
+import hashlib
+import logging
+import argparse
+import itertools
+import tempfile
+import traceback
+import multiprocessing
+import collections
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from tensorflow import keras
+import utils
+from train_addr import get_parser, model_define, compile_model, fit_data, predict_metric, get_logging_name, check_args
+
+
+# the options load_data_ours reads; trials that agree on them share one dataset
+DATA_ARGS = ('dataset', 'use_poiprox', 'use_locfeat', 'ncols', 'nrows', 'use_quadtree', 'quadtree_capacity', 'prune_neighbors')
+DATASET_NAMES = ('X_train', 'Nidx_train', 'Ndist_train', 'Eidx_train', 'Edist_train', 'y_train',
+                 'X_test', 'Nidx_test', 'Ndist_test', 'Eidx_test', 'Edist_test', 'y_test')
+
+_datasets = {}  # per worker: data directory -> (dataset, metadata)
+_running_dir = None
+
+
+def data_key(args):
+    key = tuple(getattr(args, name) for name in DATA_ARGS)
+    if args.prune_neighbors:    # the kept neighbor width depends on the radii
+        key += (args.sigma, args.sigma2)
+    return key
+
+
+def parse_value(action, text):
+    if action.const is True and action.nargs == 0:     # store_true
+        if text.lower() not in ('true', 'false', '1', '0'):
+            raise ValueError(f'--{action.dest} is a flag, expected true or false, got {text!r}')
+        return text.lower() in ('true', '1')
+    value = (action.type or str)(text)
+    if action.choices is not None and value not in action.choices:
+        raise ValueError(f'--{action.dest}: {value!r} is not one of {action.choices}')
+    return value
+
+
+def parse_space(parser, entries):
+    '''{option: [values] or ('range', low, high)} from "name=v1,v2,..." and "name=low:high" entries.'''
+    actions = {action.dest: action for action in parser._actions}
+    space = {}
+    for entry in entries:
+        name, _, values = entry.partition('=')
+        if name not in actions or name in ('help', 'space') or not values:
+            raise ValueError(f'--space {entry!r}: expected option=v1,v2,... with an option of train_addr.py')
+        action = actions[name]
+        if ':' in values and action.type in (int, float):
+            low, high = (action.type(v) for v in values.split(':'))
+            space[name] = ('range', low, high)
+        else:
+            space[name] = [parse_value(action, v) for v in values.split(',')]
+    return space
+
+
+def draw(values, rng):
+    if isinstance(values, list):
+        return rng.choice(values)
+    _, low, high = values
+    if low > 0:
+        value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    else:
+        value = rng.uniform(low, high)
+    return type(low)(round(value)) if isinstance(low, int) else value
+
+
+def make_trials(space, samples, seed):
+    '''Every combination of the space, or ``samples`` random draws from it.'''
+    names = list(space)
+    if samples > 0:
+        rng = random.Random(seed)
+        return [{name: draw(space[name], rng) for name in names} for _ in range(samples)]
+    if any(not isinstance(values, list) for values in space.values()):
+        raise ValueError('ranges (low:high) need random search, set --samples')
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+
+def save_dataset(args, directory):
+    '''load_data_ours(args) written to ``directory``: the arrays as .npy files, the rest of metadata pickled.'''
+    dataset, metadata = utils.dataloader.load_data_ours(args)
+    os.makedirs(directory, exist_ok=True)
+    metadata = dict(metadata)
+    metadata.pop('args')    # of the first trial only, run_trial adds each trial's own
+    for name, values in zip(DATASET_NAMES, dataset):
+        np.save(os.path.join(directory, name + '.npy'), values)
+    np.save(os.path.join(directory, 'Train_features.npy'), metadata.pop('Train_features'))
+    with open(os.path.join(directory, 'metadata.pkl'), 'wb') as f:
+        pickle.dump(metadata, f)
+
+
+def shared_dataset(directory):
+    '''The dataset saved in ``directory``, memory-mapped read-only on first use and kept by the worker.'''
+    if directory not in _datasets:
+        load = lambda name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+        with open(os.path.join(directory, 'metadata.pkl'), 'rb') as f:
+            metadata = pickle.load(f)
+        metadata['Train_features'] = load('Train_features')
+        _datasets[directory] = tuple(load(name) for name in DATASET_NAMES), metadata
+    return _datasets[directory]
+
+
+def init_worker(threads, data_root):
+    global _running_dir
+    _running_dir = os.path.join(data_root, 'running')
+    os.makedirs(_running_dir, exist_ok=True)
+    import tensorflow as tf
+    if threads > 0:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(min(2, threads))
+
+
+def run_trial(task):
+    '''Train and test one point of the sweep in a worker; returns its result record.'''
+    index, params, args, directory = task
+    result = dict(trial=index, params=params, pid=os.getpid())
+    # left behind if the process dies in the trial, see running_trials
+    marker = os.path.join(_running_dir, str(os.getpid()))
+    with open(marker, 'w') as f:
+        f.write(str(index))
+    try:
+        start = time.perf_counter()
+        keras.backend.clear_session()
+        utils.set_precision(args.precision)
+        if args.jit_compile:
+            utils.enable_compilation_cache(args.xla_cache_dir)
+        dataset, metadata = shared_dataset(directory)
+        metadata = dict(metadata, args=args)
+        X_train, Nidx_train, Ndist_train, Eidx_train, Edist_train, y_train, \
+                X_test , Nidx_test , Ndist_test , Eidx_test, Edist_test, y_test = dataset
+        model, model_name = model_define(args, metadata)
+        compile_model(model, args)
+        result['setup_time'] = time.perf_counter() - start
+
+        early_stopping = keras.callbacks.EarlyStopping(monitor="val_loss", patience=args.patience_stop)
+        best_weights = utils.BestWeights(monitor='val_loss')
+        callbacks = [early_stopping, best_weights,
+                     keras.callbacks.ReduceLROnPlateau(monitor="val_loss", patience=args.patience_lr)]
+        start = time.perf_counter()
+        history = model.fit(**fit_data(args, (X_train, Nidx_train, Ndist_train, Eidx_train, Edist_train), y_train),
+                            epochs=args.max_epoch, verbose=0, callbacks=callbacks)
+        y_pred, metric = predict_metric(model, args, (X_test, Nidx_test, Ndist_test, Eidx_test, Edist_test), y_test)
+        result['train_time'] = time.perf_counter() - start
+
+        name = f'{get_logging_name(args, model_name)}_sweep_{index}'
+        np.save(f'prediction/{args.dataset}/{name}.npy', y_pred)
+        result.update(name=name, epochs=len(history.epoch), best_epoch=best_weights.best_epoch + 1,
+                      val_loss=float(best_weights.best), metric=[float(m) for m in metric])
+    except Exception:
+        result['error'] = traceback.format_exc()
+    os.remove(marker)
+    return result
+
+
+def running_trials(data_root):
+    '''
+    {worker pid: trial} of the trials in progress when the pool broke (their
+    workers never removed the marker), clearing the markers.
+    '''
+    running = {}
+    directory = os.path.join(data_root, 'running')
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        with open(os.path.join(directory, name)) as f:
+            running[int(name)] = int(f.read())
+        os.remove(os.path.join(directory, name))
+    return running
+
+
+def crashed_workers(processes):
+    '''
+    Pids of the workers that died on their own. When one dies the executor
+    terminates the others (SIGTERM), which are not to blame for their trials.
+    '''
+    return {pid for pid, p in processes.items() if p.exitcode not in (0, -signal.SIGTERM)}
+
+
+def record(result, results, total, out):
+    results.append(result)
+    out.write(json.dumps(result) + '\n')
+    out.flush()
+    if 'error' in result:
+        print(f'({len(results)}/{total}) trial {result["trial"]} {result["params"]} failed:\n{result["error"]}')
+        logging.info(f'Trial {result["trial"]} \t {result["params"]} \t failed \t {result["error"]}')
+        return
+    print(f'({len(results)}/{total}) trial {result["trial"]} {result["params"]}: best epoch {result["best_epoch"]}, '
+          f'setup {result["setup_time"]:.1f}s, train {result["train_time"]:.1f}s', result['metric'])
+    logging.info(f'Test: \ttrial {result["trial"]} \t {result["params"]} \t {result["name"]} \t {result["metric"]}')
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument('--space', type=str, action='append', default=[]) # option=v1,v2,... or option=low:high, repeated
+    parser.add_argument('--samples', type=int, default=0) # random search with this many trials, 0: full grid
+    parser.add_argument('--seed', type=int, default=0) # of the random search
+    parser.add_argument('--workers', type=int, default=1) # trials trained at the same time
+    parser.add_argument('--threads', type=int, default=0) # TF threads per worker, 0: CPU count / workers
+    parser.add_argument('--data_dir', type=str, default=None) # where the datasets are shared, default a temporary directory
+    parser.add_argument('--results', type=str, default='sweep_results.jsonl')
+    args = parser.parse_args()
+    try:
+        space = parse_space(parser, args.space)
+        trials = make_trials(space, args.samples, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.restore_model or args.train_again or {'restore_model', 'train_again'} & set(space):
+        parser.error('sweep trials always start from scratch')
+
+    trial_args = [argparse.Namespace(**{**vars(args), **params}) for params in trials]
+    for a in trial_args:
+        if a.use_locfeat and a.use_areaemb:
+            parser.error('--use_locfeat and --use_areaemb cannot be combined')
+        check_args(parser, a)
+    for dataset in {a.dataset for a in trial_args}:
+        os.makedirs(f'prediction/{dataset}', exist_ok=True)
+    os.makedirs('test_logs', exist_ok=True)
+
+    logging.basicConfig(filename='./test_logs/sweep.log', level=logging.INFO, format='%(asctime)s - %(message)s', filemode='w')
+    logging.info(str(args))
+
+    with tempfile.TemporaryDirectory(prefix='sweep_data_') as tmp_dir:
+        # one load per dataset variant, the workers memory-map the saved arrays
+        data_root = args.data_dir or tmp_dir
+        directories = {}
+        for a in trial_args:
+            key = data_key(a)
+            if key not in directories:
+                directories[key] = os.path.join(data_root, hashlib.md5(repr(key).encode()).hexdigest())
+                start = time.perf_counter()
+                save_dataset(a, directories[key])
+                logging.info(f'dataset {key} prepared in {time.perf_counter() - start:.1f}s')
+        tasks = [(i, params, a, directories[data_key(a)]) for i, (params, a) in enumerate(zip(trials, trial_args))]
+        tasks.sort(key=lambda task: data_key(task[2]))  # a worker's next trial most likely reuses its dataset
+
+        num_trials = len(tasks)
+        threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+        print(f'{num_trials} trials, {len(directories)} datasets, {args.workers} workers of {threads} threads')
+        results, crashes = [], collections.Counter()
+        start = time.perf_counter()
+        with open(args.results, 'w') as out:
+            while tasks:
+                # a worker killed by native code (an abort, the OOM killer) breaks the pool; the trials it did
+                # not finish are run again in a new one, a trial whose own worker died twice has failed
+                unfinished = []
+                with ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=init_worker, initargs=(threads, data_root)) as pool:
+                    futures = {pool.submit(run_trial, task): task for task in tasks}
+                    processes = pool._processes     # pid -> Process, to read the exit codes after shutdown
+                    for future in as_completed(futures):
+                        try:
+                            record(future.result(), results, num_trials, out)
+                        except BrokenProcessPool:
+                            unfinished.append(futures[future])
+                running = running_trials(data_root)
+                crashed = {running[pid] for pid in crashed_workers(processes) if pid in running}
+                if unfinished and not crashed:
+                    crashed = set(running.values())     # no exit code to go by (killed with SIGTERM): blame them all
+                tasks = []
+                for task in unfinished:
+                    crashes[task[0]] += task[0] in crashed
+                    if crashes[task[0]] < 2:
+                        tasks.append(task)
+                    else:
+                        record(dict(trial=task[0], params=task[1], error='worker process died during the trial'), results, num_trials, out)
+        elapsed = time.perf_counter() - start
+
+    done = sorted((r for r in results if 'error' not in r), key=lambda r: r['metric'][0])
+    print(f'{"trial":>6}{"epoch":>7}{"time(s)":>9}{"MALE":>9}{"RMSE":>12}{"MAPE":>9}  params')
+    for r in done:
+        male, rmse, mape = r['metric']
+        print(f'{r["trial"]:>6}{r["best_epoch"]:>7}{r["train_time"]:>9.1f}{male:>9.4f}{rmse:>12.1f}{mape:>9.4f}  {r["params"]}')
+    print(f'{len(done)} of {num_trials} trials in {elapsed:.1f}s; results in {args.results}')
+    logging.info(f'{len(done)} of {num_trials} trials in {elapsed:.1f}s')
@@ -51,26 +51,121 @@ def model_define(args, metadata):
     return model, model_name
 
 
+def make_optimizer(args):
+    if args.optimizer == 'sgd':
+        optimizer = tf.keras.optimizers.SGD(learning_rate = args.learning_rate)
+    elif args.optimizer == 'adam':
+        optimizer = keras.optimizers.Adam(args.learning_rate)
+    elif args.optimizer == 'adagrad':
+        optimizer = keras.optimizers.Adagrad(args.learning_rate)
+    return optimizer
+
+
+def compile_model(model, args):
+    from tensorflow.keras.metrics import RootMeanSquaredError
+    model.compile(loss='mae', optimizer=make_optimizer(args), metrics=[RootMeanSquaredError()], jit_compile=args.jit_compile)
+    return model
+
+
+def fit_data(args, train_inputs, y_train):
+    '''model.fit data arguments: a tf.data pipeline or in-memory arrays with validation_split.'''
+    batch_size = len(y_train) if args.full_batch else args.batch_size   # one step per epoch
+    if args.use_tfdata:
+        train_ds, val_ds = utils.make_train_val_datasets(train_inputs, y_train, batch_size, args.val_ratio)
+        return dict(x=train_ds, validation_data=val_ds)
+    return dict(x=train_inputs, y=y_train, batch_size=batch_size, validation_split=args.val_ratio)
+
+
+def predict_metric(model, args, test_inputs, y_test, verbose=0):
+    y_pred = model.predict(test_inputs, batch_size=args.batch_size, verbose=verbose)
+    return y_pred, utils.metric(np.exp(y_test), np.exp(y_pred))
+
+
+def reset_training_state(model, weights, args):
+    '''
+    Put the model back to ``weights`` with a fresh optimizer state (zeroed slots
+    and step counter, initial learning rate). The compiled train/predict
+    functions are kept, so the next fit does not retrace.
+    '''
+    model.set_weights(weights)
+    optimizer = getattr(model.optimizer, 'inner_optimizer', model.optimizer)   # not the loss scale
+    for v in optimizer.variables:
+        v.assign(tf.zeros_like(v))
+    keras.backend.set_value(optimizer.learning_rate, args.learning_rate)
+
+
+def get_logging_name(args, model_name):
+    '''
+    Name of the checkpoint, log and prediction files of a train_addr.py run.
+    Every option that changes the weight layout is part of it, so runs that
+    cannot load each other's checkpoints never share one; the default options
+    keep the original names.
+    '''
+    latlon_type = args.use_areaemb
+    if args.use_areaemb and args.use_sinusoidal:
+        latlon_type = 'Sinusoidal'
+    if args.use_locfeat:
+        latlon_type = 'Locfeat'
+    name = f'{args.dataset}_{model_name}_{args.D}_{args.sigma}_{args.sigma2}_loc_{latlon_type}_poi_{args.use_poiprox}'
+    if args.use_areaemb:
+        # area embedding width (full rows) and trainable table shape (cells)
+        if args.area_emb_full:
+            name += '_full'
+        if args.train_areaemb:
+            name += '_trainemb'
+        parser = get_parser()
+        if (args.ncols, args.nrows) != (parser.get_default('ncols'), parser.get_default('nrows')):
+            name += f'_grid_{args.ncols}x{args.nrows}'
+        if args.use_quadtree:
+            name += f'_quadtree_{args.quadtree_capacity}'
+    return name
+
+
+def check_args(parser, args):
+    '''parser.error for option combinations the model cannot run.'''
+    if args.jit_compile and (args.ragged_attention or args.graph_attention):
+        parser.error('--ragged_attention and --graph_attention have data-dependent shapes and cannot be jit-compiled')
+    if args.graph_attention and not args.full_batch:
+        parser.error('--graph_attention projects every training house per step and needs --full_batch')
+
+
+def attention_layer(model):
+    '''The layer of ``model`` with runtime sigma (set_sigma), e.g. AMMASI.'''
+    return next(layer for layer in model.layers if hasattr(layer, 'set_sigma'))
+
+
 # In[3]:
 
 
-if __name__ == "__main__":
+def get_parser():
     parser = argparse.ArgumentParser(description='parameter')
     parser.add_argument('--dataset', type=str, choices=['fc', 'kc', 'sp', 'poa'], default='fc')
     parser.add_argument('--use_areaemb', action='store_true')
+    parser.add_argument('--train_areaemb', action='store_true') # fine-tune the area embedding table
+    parser.add_argument('--area_emb_full', action='store_true') # gather whole (cells, C) rows of the npy area embedding instead of the original flattening
     parser.add_argument('--use_locfeat', action='store_true')
 
     parser.add_argument('--use_sinusoidal', action='store_true')
     parser.add_argument('--use_poiprox', action='store_true')
     parser.add_argument('--model_name', type=str, default=f'AMMASI')
-    parser.add_argument('--restore_model', action='store_true')
-    parser.add_argument('--train_again', action='store_true')
+    parser.add_argument('--restore_model', action='store_true') # resume the interrupted (or finished) run where it left off
+    parser.add_argument('--train_again', action='store_true') # new run starting from the saved best weights
+    parser.add_argument('--state_every', type=int, default=0) # epochs between saves of the resumable training state, 0 disables
     parser.add_argument('--D', type=int, default=64) # hidden dimension
     parser.add_argument('--K', type=int, default=8) # stack of layers
     parser.add_argument('--d', type=int, default=8) # stack of layers
     parser.add_argument('--sigma', type=float, default=0.02) # stack of layers
     parser.add_argument('--sigma2', type=float, default=0.02) # stack of layers
+    parser.add_argument('--fused_attention', action='store_true') # both neighbor branches in one batched attention
+    parser.add_argument('--kv_cache', action='store_true') # precomputed neighbor keys/values at inference
+    parser.add_argument('--ragged_attention', action='store_true') # attend over in-radius neighbors only
+    parser.add_argument('--graph_attention', action='store_true') # with --full_batch: project every house once per step, segment softmax over the in-radius edges
+    parser.add_argument('--prune_neighbors', action='store_true') # drop neighbor columns outside sigma/sigma2 when loading
     parser.add_argument('--val_ratio', type=float, default=0.1)
+    parser.add_argument('--ncols', type=int, default=100) # area embedding grid
+    parser.add_argument('--nrows', type=int, default=100)
+    parser.add_argument('--use_quadtree', action='store_true') # adaptive cells, at most ncols * nrows
+    parser.add_argument('--quadtree_capacity', type=int, default=32) # houses per cell before splitting
     
     parser.add_argument('--batch_size', type=int, default=250)
     parser.add_argument('--max_epoch', type=int, default=100)
@@ -78,8 +173,25 @@ if __name__ == "__main__":
     parser.add_argument('--learning_rate', type=float, default=0.008)
     parser.add_argument('--patience_stop', type=int, default=10)
     parser.add_argument('--patience_lr', type=int, default=5)
-    
+    parser.add_argument('--full_batch', action='store_true') # the whole training split as one batch
+    parser.add_argument('--eval_every', type=int, default=5) # epochs between background test evaluations, 0 disables
+    parser.add_argument('--use_tfdata', action='store_true') # tf.data input pipeline with prefetching
+    parser.add_argument('--jit_compile', action='store_true') # XLA-compiled train/predict steps
+    parser.add_argument('--precision', type=str, choices=['float32', 'mixed_bfloat16', 'mixed_float16'], default='float32')
+    parser.add_argument('--xla_cache_dir', type=str, default='./xla_cache') # persistent XLA compilation cache
+    return parser
+
+
+if __name__ == "__main__":
+    parser = get_parser()
     args = parser.parse_args()
+    if args.restore_model and args.train_again:
+        parser.error('--restore_model resumes the saved run, --train_again starts a new one from its weights')
+    check_args(parser, args)
+
+    utils.set_precision(args.precision)
+    if args.jit_compile:
+        utils.enable_compilation_cache(args.xla_cache_dir)
     
     if not os.path.isdir('prediction'):
         os.mkdir('prediction')
@@ -109,15 +221,10 @@ if __name__ == "__main__":
     
     
     model, model_name = model_define(args, metadata)
-    latlon_type = args.use_areaemb
-    if args.use_areaemb and args.use_sinusoidal:
-        latlon_type = 'Sinusoidal'
-    if args.use_locfeat:
-        latlon_type = 'Locfeat'
     if args.use_locfeat and args.use_areaemb:
         import sys
         sys.exit(-1)
-    model_logging_name = f'{args.dataset}_{model_name}_{args.D}_{args.sigma}_{args.sigma2}_loc_{latlon_type}_poi_{args.use_poiprox}'
+    model_logging_name = get_logging_name(args, model_name)
     model_checkpoint = f'./model_checkpoint/{args.dataset}/{model_logging_name}'
     model_logs = f'./model_logs/{args.dataset}/{model_logging_name}'
 
@@ -126,28 +233,30 @@ if __name__ == "__main__":
     #     import sys
     #     sys.exit(0)
     
-    if args.optimizer == 'sgd':
-        optimizer = tf.keras.optimizers.SGD(learning_rate = args.learning_rate)
-    elif args.optimizer == 'adam':
-        optimizer = keras.optimizers.Adam(args.learning_rate)
-    elif args.optimizer == 'adagrad':
-        optimizer = keras.optimizers.Adagrad(args.learning_rate)
-
-    from tensorflow.keras.metrics import MeanAbsoluteError, RootMeanSquaredError
-    model.compile(loss='mae', optimizer=optimizer, metrics=[RootMeanSquaredError()])
+    compile_model(model, args)
     model.summary()
 
     # Define some callbacks to improve training.            
     early_stopping = keras.callbacks.EarlyStopping(monitor="val_loss", patience=args.patience_stop)
     reduce_lr = keras.callbacks.ReduceLROnPlateau(monitor="val_loss", patience=args.patience_lr)
-    model_ckpt = tf.keras.callbacks.ModelCheckpoint(model_checkpoint, save_weights_only=True, \
-                    save_best_only=True, monitor='val_loss', mode='min', verbose=0)
+    # best weights kept in memory and restored in place, the checkpoint file is written in the background
+    best_weights = utils.BestWeights(monitor='val_loss', path=model_checkpoint + '.npz')
 #     time_callback = utils.TimeHistory()
     # tb_callback = TensorBoard(log_dir=model_logs, histogram_freq=1, write_graph=True, write_images=True)
 #     logging_callback = LoggingCallback()
 
     
-    logging.basicConfig(filename=f'./test_logs/{args.dataset}/{model_logging_name}.log', level=logging.INFO, format='%(asctime)s - %(message)s', filemode='w')
+    # weights, optimizer, callback and RNG state, to continue a killed run with --restore_model
+    training_state = utils.ResumableState(f'{model_checkpoint}_state', [early_stopping, reduce_lr, best_weights], every=args.state_every)
+    initial_epoch = 0
+    if args.restore_model and training_state.load():
+        initial_epoch = training_state.initial_epoch(args.max_epoch)
+    else:
+        training_state.clear()
+    if args.train_again:
+        model.set_weights(utils.read_weights(model_checkpoint + '.npz'))
+
+    logging.basicConfig(filename=f'./test_logs/{args.dataset}/{model_logging_name}.log', level=logging.INFO, format='%(asctime)s - %(message)s', filemode='a' if args.restore_model else 'w')
     logging.info(str(args))
     
     # Custom callback for logging metrics during training and testing
@@ -155,29 +264,23 @@ if __name__ == "__main__":
         def on_epoch_end(self, epoch, logs=None):
             if logs is not None:
                 logging.info(f"Epoch {epoch + 1}: "+ str(logs))
-                
-            if (epoch+1) % 5 == 0:
-                y_pred = self.model.predict((X_test, Nidx_test, Ndist_test, Eidx_test, Edist_test), batch_size=args.batch_size, verbose=0)
-                print('TESTING...', f'Test epoch: {epoch+1}', args.dataset, utils.metric(np.exp(y_test), np.exp(y_pred)))
-                print(f'Test epoch: {epoch+1}', args.dataset, utils.metric(np.exp(y_test), np.exp(y_pred)))
-                logging.info(f'Test epoch: {epoch+1} \t {args.dataset} \t {utils.metric(np.exp(y_test), np.exp(y_pred))}')
 
 
     logging_callback = LoggingCallback()
+    # periodic test metrics on a copy of the weights, in a background thread
+    test_callback = utils.AsyncEvaluator(lambda: compile_model(model_define(args, metadata)[0], args),
+                                         lambda evaluator: predict_metric(evaluator, args, (X_test, Nidx_test, Ndist_test, Eidx_test, Edist_test), y_test)[1],
+                                         every=args.eval_every, tag=args.dataset)
+    throughput_callback = utils.ThroughputCallback(int(len(y_train) * (1 - args.val_ratio)) if args.full_batch else args.batch_size)
 
-
-    model.fit((X_train, Nidx_train, Ndist_train, Eidx_train, Edist_train), y_train,
-                batch_size=args.batch_size,
+    model.fit(**fit_data(args, (X_train, Nidx_train, Ndist_train, Eidx_train, Edist_train), y_train),
                 epochs=args.max_epoch,
+                initial_epoch=initial_epoch,
                 verbose=1,
-                validation_split=0.1,
-                callbacks=[early_stopping, model_ckpt, reduce_lr, logging_callback],
+                callbacks=[early_stopping, best_weights, reduce_lr, throughput_callback, logging_callback, test_callback, training_state],
     )
 
-    model, model_name = model_define(args, metadata)
-    model.load_weights(model_checkpoint)
-    
-    y_pred = model.predict((X_test, Nidx_test, Ndist_test, Eidx_test, Edist_test), batch_size=args.batch_size)
+    y_pred, _ = predict_metric(model, args, (X_test, Nidx_test, Ndist_test, Eidx_test, Edist_test), y_test, verbose=1)
 
     print(model_name, args.dataset, utils.metric(np.exp(y_test), np.exp(y_pred)))
     logging.info(f'Test: \t{model_name} \t {args.dataset} \t {utils.metric(np.exp(y_test), np.exp(y_pred))}')
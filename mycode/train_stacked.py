@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+Train several AMMASI variants at once. Every (sigma, sigma2, learning_rate)
+combination becomes one slice of a StackedAMMASI: the variants share the
+input pipeline and the neighbour rows gathered from Train_features and take
+one batched step per batch, each with its own Adam state, learning rate
+schedule (ReduceLROnPlateau), early stopping and best weights:
+
+    python train_stacked.py --dataset fc --use_areaemb --use_poiprox --sigmas 0.01,0.02,0.05 --sigma2s 0.02 --learning_rates 0.008,0.004
+
+Predictions and test logs are written per variant under the names train_addr.py uses.
+'''
+
+import os
+import time
+import argparse
+import logging
+import itertools
+import numpy as np
+import tensorflow as tf
+import mymodels
+import utils
+from train_addr import get_parser, get_logging_name
+
+
+class StackedAdam:
+    '''
+    Adam over stacked weights (leading variant axis) with a learning rate and
+    step counter per variant, matching keras.optimizers.Adam for each slice.
+    A variant with learning rate 0 is frozen: its weights, moments and step
+    stay as they are.
+    '''
+    def __init__(self, variables, learning_rates, beta_1=0.9, beta_2=0.999, epsilon=1e-7):
+        self.variables = variables
+        self.beta_1, self.beta_2, self.epsilon = beta_1, beta_2, epsilon
+        self.learning_rate = tf.Variable(learning_rates, dtype=tf.float32, trainable=False)
+        self.step = tf.Variable(tf.zeros(len(learning_rates)), trainable=False)
+        self.m = [tf.Variable(tf.zeros_like(v), trainable=False) for v in variables]
+        self.v = [tf.Variable(tf.zeros_like(v), trainable=False) for v in variables]
+
+    def apply_gradients(self, grads):
+        active = tf.cast(self.learning_rate > 0, tf.float32)
+        step = self.step.assign_add(active)
+        t = tf.maximum(step, 1.)
+        alpha = self.learning_rate * tf.sqrt(1. - self.beta_2 ** t) / (1. - self.beta_1 ** t)
+        for var, g, m, v in zip(self.variables, grads, self.m, self.v):
+            per_variant = lambda x: tf.reshape(x, [-1] + [1] * (var.shape.rank - 1))
+            a = per_variant(active)
+            m.assign(m + a * (1. - self.beta_1) * (g - m))
+            v.assign(v + a * (1. - self.beta_2) * (tf.square(g) - v))
+            var.assign_sub(per_variant(alpha) * m / (tf.sqrt(v) + self.epsilon))
+
+
+class VariantSchedule:
+    '''Per-variant EarlyStopping and ReduceLROnPlateau on val_loss, with the keras defaults.'''
+    def __init__(self, variants, patience_stop, patience_lr, factor=0.1, min_delta_lr=1e-4):
+        self.patience_stop, self.patience_lr = patience_stop, patience_lr
+        self.factor, self.min_delta_lr = factor, min_delta_lr
+        self.best = np.full(variants, np.inf)
+        self.best_epoch = np.zeros(variants, int)
+        self.best_lr_loss = np.full(variants, np.inf)
+        self.wait_stop = np.zeros(variants, int)
+        self.wait_lr = np.zeros(variants, int)
+        self.stopped = np.zeros(variants, bool)
+
+    def update(self, epoch, val_loss, learning_rate):
+        '''Returns the variants that improved and the new learning rates (0 for stopped variants).'''
+        running = ~self.stopped
+        improved = running & (val_loss < self.best)
+        self.best[improved], self.best_epoch[improved] = val_loss[improved], epoch
+        self.wait_stop = np.where(improved, 0, self.wait_stop + running)
+        self.stopped |= running & (self.wait_stop >= self.patience_stop) & (epoch > 0)
+
+        improved_lr = val_loss < self.best_lr_loss - self.min_delta_lr
+        self.best_lr_loss[improved_lr] = val_loss[improved_lr]
+        self.wait_lr = np.where(improved_lr, 0, self.wait_lr + running)
+        reduce = running & (self.wait_lr >= self.patience_lr)
+        learning_rate = np.where(reduce, learning_rate * self.factor, learning_rate)
+        self.wait_lr[reduce] = 0
+        return improved, np.where(self.stopped, 0., learning_rate)
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument('--sigmas', type=utils.float_list, default=None) # comma separated, default --sigma
+    parser.add_argument('--sigma2s', type=utils.float_list, default=None) # comma separated, default --sigma2
+    parser.add_argument('--learning_rates', type=utils.float_list, default=None) # comma separated, default --learning_rate
+    args = parser.parse_args()
+    if args.optimizer != 'adam' or args.precision != 'float32':
+        parser.error('the stacked trainer supports --optimizer adam and --precision float32 only')
+    # options of train_addr.py that StackedAMMASI or this trainer do not implement
+    unsupported = [f'--{name}' for name in ('train_areaemb', 'use_sinusoidal', 'use_locfeat', 'fused_attention', 'kv_cache',
+                                             'ragged_attention', 'graph_attention', 'full_batch', 'restore_model', 'train_again')
+                   if getattr(args, name)]
+    if args.state_every > 0:
+        unsupported.append('--state_every')
+    if unsupported:
+        parser.error(f'not supported by the stacked trainer: {" ".join(unsupported)}')
+    configs = list(itertools.product(args.sigmas or [args.sigma], args.sigma2s or [args.sigma2],
+                                     args.learning_rates or [args.learning_rate]))
+    sigmas, sigma2s, learning_rates = (list(c) for c in zip(*configs))
+
+    for d in ('prediction', 'test_logs'):
+        if not os.path.isdir(f'{d}/{args.dataset}'):
+            os.makedirs(f'{d}/{args.dataset}')
+
+    # pruned neighbor columns have to cover the widest radius
+    args.sigma, args.sigma2 = max(sigmas), max(sigma2s)
+    dataset, metadata = utils.dataloader.load_data_ours(args)
+    X_train, Nidx_train, Ndist_train, Eidx_train, Edist_train, y_train, \
+            X_test , Nidx_test , Ndist_test , Eidx_test, Edist_test, y_test = dataset
+    cast = lambda inputs: tuple(np.asarray(x, np.int32 if i in (1, 3) else np.float32) for i, x in enumerate(inputs))
+    train_inputs = cast((X_train, Nidx_train, Ndist_train, Eidx_train, Edist_train))
+    test_inputs = cast((X_test, Nidx_test, Ndist_test, Eidx_test, Edist_test))
+    train_ds, val_ds = utils.make_train_val_datasets(train_inputs, np.asarray(y_train, np.float32), args.batch_size, args.val_ratio)
+    test_ds = utils.make_dataset(test_inputs, batch_size=args.batch_size)
+
+    model = mymodels.StackedAMMASI(args, metadata, sigmas, sigma2s)
+    model(*(x[:1] for x in train_inputs))
+    variables = model.trainable_variables
+    optimizer = StackedAdam(variables, learning_rates)
+    schedule = VariantSchedule(len(configs), args.patience_stop, args.patience_lr)
+    best_weights = [v.numpy() for v in variables]
+
+    def variant_mae(y, y_pred):
+        return tf.reduce_mean(tf.abs(y_pred - y[None]), axis=[1, 2])          # (V,)
+
+    @tf.function(jit_compile=args.jit_compile)
+    def train_step(inputs, y):
+        with tf.GradientTape() as tape:
+            loss = variant_mae(y, model(*inputs))
+            # the variants are independent, so the gradient of the sum is each variant's own gradient
+            total_loss = tf.reduce_sum(loss)
+        optimizer.apply_gradients(tape.gradient(total_loss, variables))
+        return loss
+
+    @tf.function(jit_compile=args.jit_compile)
+    def predict_step(inputs):
+        return model(*inputs)
+
+    logging.basicConfig(filename=f'./test_logs/{args.dataset}/{args.dataset}_StackedAMMASI_{args.D}.log', level=logging.INFO, format='%(asctime)s - %(message)s', filemode='w')
+    logging.info(str(args))
+
+    start = time.perf_counter()
+    for epoch in range(args.max_epoch):
+        train_loss = np.mean([train_step(x, y).numpy() for x, y in train_ds], 0)
+        val_loss, val_count = 0., 0
+        for x, y in val_ds:
+            val_loss, val_count = val_loss + variant_mae(y, predict_step(x)).numpy() * len(y), val_count + len(y)
+        val_loss /= val_count
+        improved, learning_rate = schedule.update(epoch, val_loss, optimizer.learning_rate.numpy())
+        optimizer.learning_rate.assign(learning_rate)
+        for best, v in zip(best_weights, variables):
+            best[improved] = v.numpy()[improved]
+        print(f'Epoch {epoch + 1}: val_loss', np.round(val_loss, 4), f'{int((~schedule.stopped).sum())} running')
+        logging.info(f'Epoch {epoch + 1}: loss {train_loss.tolist()} val_loss {val_loss.tolist()} lr {learning_rate.tolist()}')
+        if schedule.stopped.all():
+            break
+    for best, v in zip(best_weights, variables):
+        v.assign(best)
+    elapsed = time.perf_counter() - start
+
+    y_pred = np.concatenate([predict_step(x).numpy() for x, in test_ds], 1)  # (V, n_test, 1)
+    np.save(f'prediction/{args.dataset}/ground_truth.npy', y_test)
+    print(f'{"sigma":>8}{"sigma2":>8}{"lr":>8}{"epoch":>7}{"MALE":>9}{"RMSE":>12}{"MAPE":>9}')
+    for i, (sigma, sigma2, learning_rate) in enumerate(configs):
+        metric = utils.metric(np.exp(y_test), np.exp(y_pred[i]))
+        model_logging_name = get_logging_name(argparse.Namespace(**{**vars(args), 'sigma': sigma, 'sigma2': sigma2}), 'AMMASI')
+        np.save(f'prediction/{args.dataset}/{model_logging_name}_lr_{learning_rate}.npy', y_pred[i])
+        logging.info(f'Test: \tAMMASI \t {args.dataset} \t sigma {sigma} \t sigma2 {sigma2} \t lr {learning_rate} \t {metric}')
+        print(f'{sigma:>8}{sigma2:>8}{learning_rate:>8}{schedule.best_epoch[i] + 1:>7}{metric[0]:>9.4f}{metric[1]:>12.1f}{metric[2]:>9.4f}')
+    print(f'{len(configs)} variants trained in {elapsed:.1f}s')
+    logging.info(f'{len(configs)} variants trained in {elapsed:.1f}s')
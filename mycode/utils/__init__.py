@@ -1,2 +1,6 @@
 from utils.dataloader import *
-from utils.metric import *
\ No newline at end of file
+from utils.metric import *
+from utils.pipeline import *
+from utils.callbacks import *
+from utils.execution import *
+from utils.arguments import *
@@ -0,0 +1,8 @@
+def float_list(text):
+    '''argparse type of comma separated floats, e.g. --sigmas 0.01,0.02'''
+    return [float(v) for v in text.split(',')]
+
+
+def int_list(text):
+    '''argparse type of comma separated ints, e.g. --ks 4,8,16'''
+    return [int(v) for v in text.split(',')]
@@ -0,0 +1,266 @@
+import os
+import time
+import pickle
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+
+def write_weights(path, weights):
+    '''A get_weights() list as ``path`` (.npz). Written to a temporary file and renamed, so readers never see a partial file.'''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, *weights)
+    os.replace(tmp, path)
+
+
+def read_weights(path):
+    '''The weights list written by write_weights, for model.set_weights.'''
+    with np.load(path) as f:
+        return [f[f'arr_{i}'] for i in range(len(f.files))]
+
+
+class CheckpointWriter:
+    '''
+    Writes weight snapshots to one file on a background thread. Only the
+    newest snapshot not yet written is kept: improvements that come in while
+    a write is running are coalesced into one write of the latest.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.cond = threading.Condition()
+        self.latest = None
+        self.closed = False
+        self.error = None
+        self.writes = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, weights):
+        with self.cond:
+            self.latest = weights
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.latest is None and not self.closed:
+                    self.cond.wait()
+                if self.latest is None:
+                    return
+                weights, self.latest = self.latest, None
+            try:
+                write_weights(self.path, weights)
+                self.writes += 1
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        '''Write what is pending and stop; re-raises a failed write.'''
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class ThroughputCallback(keras.callbacks.Callback):
+    '''Training steps/sec and samples/sec per epoch (time spent in train batches only).'''
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.steps = 0
+        self.elapsed = 0.
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.elapsed += time.perf_counter() - self.batch_start
+        self.steps += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        steps_per_sec = self.steps / self.elapsed if self.elapsed > 0 else 0.
+        if logs is not None:
+            logs['steps_per_sec'] = steps_per_sec
+        print(f'Epoch {epoch + 1}: {steps_per_sec:.1f} steps/sec, {steps_per_sec * self.batch_size:.0f} samples/sec')
+        logging.info(f'Throughput epoch {epoch + 1}: {steps_per_sec:.1f} steps/sec')
+
+
+class BestWeights(keras.callbacks.Callback):
+    '''
+    Keeps the weights of the best epoch (lowest ``monitor``) in memory and puts
+    them back when training ends. With ``path`` the best weights are also
+    saved there (read_weights) by a CheckpointWriter, off the training thread.
+    '''
+    def __init__(self, monitor='val_loss', path=None):
+        super().__init__()
+        self.monitor = monitor
+        self.path = path
+
+    def on_train_begin(self, logs=None):
+        self.best = float('inf')
+        self.best_epoch = None
+        self.best_weights = None
+        self.writer = CheckpointWriter(self.path) if self.path else None
+
+    def on_epoch_end(self, epoch, logs=None):
+        current = (logs or {}).get(self.monitor)
+        if current is not None and current < self.best:
+            self.best = current
+            self.best_epoch = epoch
+            self.best_weights = self.model.get_weights()
+            if self.writer is not None:
+                self.writer.submit(self.best_weights)
+
+    def on_train_end(self, logs=None):
+        if self.best_weights is not None:
+            self.model.set_weights(self.best_weights)
+        if self.writer is not None:
+            self.writer.close()
+
+
+class AsyncEvaluator(keras.callbacks.Callback):
+    '''
+    Test evaluation every ``every`` epochs off the training thread. At the end
+    of the epoch the weights are copied and handed to a background thread,
+    which loads them into a separate evaluator model (built once by
+    ``model_fn``) and runs ``evaluate_fn(evaluator)``; the result is printed
+    and logged with the epoch it belongs to. Evaluations run one at a time in
+    epoch order; one that is due while another is running waits with its own
+    copy of the weights, so no epoch's test metrics are lost. ``every`` <= 0
+    disables the callback, and no evaluator model is built.
+    '''
+    def __init__(self, model_fn, evaluate_fn, every=5, tag=''):
+        super().__init__()
+        self.model_fn = model_fn
+        self.evaluate_fn = evaluate_fn
+        self.every = every
+        self.tag = tag
+
+    def on_train_begin(self, logs=None):
+        self.pending = []
+        self.results = {}
+        if self.every <= 0:
+            return
+        self.evaluator = self.model_fn()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def evaluate(self, epoch, weights):
+        self.evaluator.set_weights(weights)
+        result = self.evaluate_fn(self.evaluator)
+        self.results[epoch] = result
+        print(f'Test epoch: {epoch + 1}', self.tag, result)
+        logging.info(f'Test epoch: {epoch + 1} \t {self.tag} \t {result}')
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.every <= 0 or (epoch + 1) % self.every != 0:
+            return
+        self.pending.append(self.executor.submit(self.evaluate, epoch, self.model.get_weights()))
+
+    def on_train_end(self, logs=None):
+        if self.every <= 0:
+            return
+        self.executor.shutdown(wait=True)
+        for future in self.pending:
+            future.result()     # re-raise a failed evaluation
+        self.pending = []
+
+
+class ResumableState(keras.callbacks.Callback):
+    '''
+    Everything needed to continue an interrupted fit(), saved to ``directory``
+    every ``every`` epochs: model weights and optimizer slots (learning rate
+    and step included) in a tf.train.Checkpoint, plus a sidecar file with
+    the epoch, the counters and best values of ``callbacks``
+    (EarlyStopping, ReduceLROnPlateau, BestWeights) and the python, numpy
+    and tf global RNG states.
+
+    A new process calls fit(initial_epoch=state.initial_epoch(epochs)); the
+    rest is put back in on_train_begin, after the other callbacks have reset
+    themselves, so this callback goes last in the list. Shuffling seeded by
+    tf.data or keras ops themselves is not part of the state.
+
+    ``every`` <= 0 saves nothing (a saved state is still restored). A run
+    counts as finished only when a callback stopped it (EarlyStopping); one
+    that ran out of epochs continues when resumed with more epochs.
+    '''
+    attrs = ('wait', 'stopped_epoch', 'best', 'best_epoch', 'best_weights', 'cooldown_counter')
+
+    def __init__(self, directory, callbacks=(), every=1):
+        super().__init__()
+        self.directory = directory
+        self.callbacks = list(callbacks)
+        self.every = every
+        self.sidecar = os.path.join(directory, 'state.pkl')
+        self.state = None
+
+    def load(self):
+        '''Read the saved state, if any; returns whether there was one.'''
+        if os.path.exists(self.sidecar):
+            with open(self.sidecar, 'rb') as f:
+                self.state = pickle.load(f)
+        return self.state is not None
+
+    def clear(self):
+        self.state = None
+        if os.path.exists(self.sidecar):
+            os.remove(self.sidecar)
+
+    def initial_epoch(self, epochs):
+        '''The epoch to continue from; ``epochs`` for a run that already finished.'''
+        if self.state is None:
+            return 0
+        return epochs if self.state['finished'] else self.state['epoch']
+
+    def on_train_begin(self, logs=None):
+        self.checkpoint = tf.train.Checkpoint(model=self.model, optimizer=self.model.optimizer)
+        if self.every > 0:
+            self.manager = tf.train.CheckpointManager(self.checkpoint, self.directory, max_to_keep=2)
+        if self.state is None:
+            return
+        # slots exist only after the first step, create them so they can be restored
+        getattr(self.model.optimizer, 'inner_optimizer', self.model.optimizer).build(self.model.trainable_variables)
+        if self.state['checkpoint'] is not None:
+            self.checkpoint.read(self.state['checkpoint']).assert_existing_objects_matched().expect_partial()
+        for callback, values in zip(self.callbacks, self.state['callbacks']):
+            for name, value in values.items():
+                setattr(callback, name, value)
+        random.setstate(self.state['random'])
+        np.random.set_state(self.state['numpy'])
+        tf.random.get_global_generator().reset(self.state['tf'])
+        print(f'Resumed from epoch {self.state["epoch"]} ({self.state["checkpoint"]})')
+
+    def save(self, epoch, finished=False):
+        if not finished:
+            checkpoint = self.manager.save(checkpoint_number=epoch)
+        else:
+            checkpoint = self.state['checkpoint'] if self.state is not None else None
+        state = dict(epoch=epoch, finished=finished, checkpoint=checkpoint,
+                     callbacks=[{name: getattr(c, name) for name in self.attrs if hasattr(c, name)} for c in self.callbacks],
+                     random=random.getstate(), numpy=np.random.get_state(),
+                     tf=tf.random.get_global_generator().state.numpy())
+        # the sidecar is replaced only once the checkpoint it points to is complete
+        with open(self.sidecar + '.tmp', 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(self.sidecar + '.tmp', self.sidecar)
+        self.state = state
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.every <= 0:
+            return
+        if (epoch + 1) % self.every == 0 or epoch + 1 == self.params['epochs'] or self.model.stop_training:
+            self.save(epoch + 1)
+
+    def on_train_end(self, logs=None):
+        # stopped early: a restart only needs the callbacks' final state (BestWeights' best weights);
+        # the model holds the best weights by now, so no new checkpoint is written
+        if self.every > 0 and self.model.stop_training:
+            self.save(self.state['epoch'] if self.state is not None else 0, finished=True)
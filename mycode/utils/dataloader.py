@@ -1,5 +1,7 @@
 import os
 import numpy as np
+from utils.datastore import open_dataset, store_path
+from utils.quadtree import QuadTree
 
 def detect_category(samples, max_category):
     uniques = list(np.unique(samples))
@@ -9,27 +11,37 @@ def detect_category(samples, max_category):
         return []
     
 
+def sort_by_distance(idx, dist):
+    order = np.argsort(dist, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, 1), np.take_along_axis(dist, order, 1)
+
+
+def radius_width(dists, radius):
+    '''Smallest neighbor width that keeps every in-radius neighbor of every row (at least 1).'''
+    return max(1, max(int((d < radius).sum(1).max(initial=0)) for d in dists))
+
+
 def load_data_ours(args):
     metadata = dict(args=args)
     print(metadata)
-    data = np.load(f'../datasets/processed/{args.dataset}/processed_data_poi.npz')
+    # memory-mapped store if converted with utils/datastore.py, npz otherwise
+    data = open_dataset(store_path(args.dataset) + '.npz')
     
-    Train_feat, Train_latlon, Train_poidist, Train_price = data['Train_feat'], data['Train_latlon'], data['Train_poidist'], data['Train_price']
-    Test_feat, Test_latlon, Test_poidist, Test_price = data['Test_feat'], data['Test_latlon'], data['Test_poidist'], data['Test_price']
+    Train_feat, Train_latlon, Train_price = data['Train_feat'], data['Train_latlon'], data['Train_price']
+    Test_feat, Test_latlon, Test_price = data['Test_feat'], data['Test_latlon'], data['Test_price']
 
     beta = {'fc': 0.045, 'kc':0.035, 'sp': 0.020, 'poa': 0.025}
-    Train_poiprox = np.exp(-(Train_poidist / beta[args.dataset])**2 / 2)
-    Test_poiprox = np.exp(-(Test_poidist / beta[args.dataset])**2 / 2)
 
-    metadata['grid_emb'] = np.load(f'../datasets/{args.dataset}/grid_vectors_gaussian.npy').astype(np.float32)
+    # (nrows * ncols, C) area embedding, memory-mapped and materialised by the model (mymodels/area_embedding.py)
+    metadata['grid_emb_path'] = f'../datasets/{args.dataset}/grid_vectors_gaussian.npy'
 
     miny = min(np.min(Train_latlon[:, 0]), np.min(Test_latlon[:, 0])) - 0.01
     maxy = max(np.max(Train_latlon[:, 0]), np.max(Test_latlon[:, 0])) + 0.01
     minx = min(np.min(Train_latlon[:, 1]), np.min(Test_latlon[:, 1])) - 0.01
     maxx = max(np.max(Train_latlon[:, 1]), np.max(Test_latlon[:, 1])) + 0.01
 
-    ncols = 100  #1000
-    nrows = 100  #int(1200 * (maxy - miny) / (maxx - minx))
+    ncols = args.ncols  # must match the grid of grid_vectors_gaussian.npy
+    nrows = args.nrows
     width = (maxx - minx) / ncols
     height = (maxy - miny) / nrows
 
@@ -51,6 +63,16 @@ def load_data_ours(args):
     Test_j = ((Test_latlon[:, 0] - miny) / height).astype(int)
     Test_ij = np.stack((Test_i, Test_j), -1)
 
+    if args.use_quadtree:
+        # adaptive cells instead of the regular grid, never more cells than the grid;
+        # houses carry (leaf id, 0) so that i + j * ncols is the leaf id
+        tree = QuadTree.build((minx, miny, maxx, maxy), np.concatenate((Train_latlon, Test_latlon), 0),
+                              capacity=args.quadtree_capacity, max_cells=ncols * nrows)
+        Train_ij = np.stack((tree.lookup(Train_latlon), np.zeros(len(Train_latlon), dtype=np.int64)), -1)
+        Test_ij = np.stack((tree.lookup(Test_latlon), np.zeros(len(Test_latlon), dtype=np.int64)), -1)
+        metadata['quadtree'] = tree
+        print('quadtree cells:', tree.num_cells)
+
     # thres_num_neighbors = 0
     # if args.dataset == 'fc':
     #     thres_num_neighbors = 20
@@ -72,6 +94,22 @@ def load_data_ours(args):
 
     # print('Eidx_test, Edist_test', Eidx_test.shape, Edist_test.shape)
 
+    if args.prune_neighbors:
+        # keep only as many (nearest) neighbor columns as the widest in-radius set needs;
+        # both branches keep one common width. Rows with no neighbor inside sigma attend
+        # uniformly over the kept nearest ones instead of over all of them.
+        Nidx_train, Ndist_train = sort_by_distance(Nidx_train, Ndist_train)
+        Nidx_test, Ndist_test = sort_by_distance(Nidx_test, Ndist_test)
+        Eidx_train, Edist_train = sort_by_distance(Eidx_train, Edist_train)
+        Eidx_test, Edist_test = sort_by_distance(Eidx_test, Edist_test)
+        width = max(radius_width((Ndist_train, Ndist_test), args.sigma),
+                    radius_width((Edist_train, Edist_test), args.sigma2))
+        print('neighbor columns kept:', width, 'of', Nidx_train.shape[1])
+        Nidx_train, Ndist_train = Nidx_train[:, :width], Ndist_train[:, :width]
+        Nidx_test, Ndist_test = Nidx_test[:, :width], Ndist_test[:, :width]
+        Eidx_train, Edist_train = Eidx_train[:, :width], Edist_train[:, :width]
+        Eidx_test, Edist_test = Eidx_test[:, :width], Edist_test[:, :width]
+
     metadata['num_neighbors'] = Nidx_train.shape[1]
     metadata['max_neighboridx'] = Train_feat.shape[0]
 
@@ -83,6 +121,8 @@ def load_data_ours(args):
     # print('args.use_poiprox', args.use_poiprox)
         
     if args.use_poiprox:
+        Train_poiprox = np.exp(-(data['Train_poidist'] / beta[args.dataset])**2 / 2)
+        Test_poiprox = np.exp(-(data['Test_poidist'] / beta[args.dataset])**2 / 2)
         X_train = np.concatenate((X_train, Train_poiprox), -1)
         X_test = np.concatenate((X_test, Test_poiprox), -1)
     if args.use_locfeat:
@@ -95,7 +135,7 @@ def load_data_ours(args):
     X_test = (X_test - X_mean) / X_std
 
 
-    metadata['poi_features'] = Train_poiprox.shape[1]
+    metadata['poi_features'] = data['Train_poidist'].shape[1]
     
     y_mean = np.mean(Train_price)
     y_std = np.std(Train_price)
@@ -0,0 +1,145 @@
+import os
+import json
+import argparse
+import numpy as np
+
+# On-disk layout of a dataset store:
+#   <store>/schema.json         field name -> file, dtype, shape
+#   <store>/<field>.npy         one uncompressed array per field
+# Fields are opened with np.load(mmap_mode=...) on first access, so only the
+# arrays a model actually reads are paged in.
+
+SCHEMA_FILE = 'schema.json'
+SCHEMA_VERSION = 1
+
+
+def store_path(dataset, root='../datasets/processed', name='processed_data_poi'):
+    return f'{root}/{dataset}/{name}'
+
+
+class ColumnStore:
+    '''
+    Read-only view over a dataset store; mirrors the parts of np.lib.npyio.NpzFile
+    that the loaders use (``files``, ``[key]``, ``in``).
+    '''
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(path, SCHEMA_FILE)) as fp:
+            schema = json.load(fp)
+        if schema.get('version') != SCHEMA_VERSION:
+            raise ValueError(f'{path}: unsupported store version {schema.get("version")}')
+        self.fields = schema['fields']
+        self._arrays = {}
+
+    @property
+    def files(self):
+        return list(self.fields)
+
+    def keys(self):
+        return self.files
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            if name not in self.fields:
+                raise KeyError(f'{name} is not a field of {self.path}')
+            field = self.fields[name]
+            array = np.load(os.path.join(self.path, field['file']), mmap_mode=self.mmap_mode)
+            if str(array.dtype) != field['dtype'] or list(array.shape) != field['shape']:
+                raise ValueError(f'{self.path}/{field["file"]} does not match its schema entry')
+            self._arrays[name] = array
+        return self._arrays[name]
+
+    def shape(self, name):
+        return tuple(self.fields[name]['shape'])
+
+    def close(self):
+        self._arrays.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, SCHEMA_FILE))
+
+
+def write_store(path, arrays):
+    '''
+    Write a mapping of name -> array as a store. Arrays are written one at a time
+    and the schema last, so a half-written store is never picked up by is_store.
+    '''
+    os.makedirs(path, exist_ok=True)
+    fields = {}
+    for name in arrays:
+        array = np.asarray(arrays[name])
+        if array.dtype.hasobject:
+            raise TypeError(f'field {name} has object dtype and cannot be memory-mapped')
+        fname = f'{name}.npy'
+        tmp = os.path.join(path, fname + '.tmp')
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=array.dtype, shape=array.shape)
+        out[...] = array
+        out.flush()
+        del out
+        os.replace(tmp, os.path.join(path, fname))
+        fields[name] = dict(file=fname, dtype=str(array.dtype), shape=list(array.shape))
+
+    tmp = os.path.join(path, SCHEMA_FILE + '.tmp')
+    with open(tmp, 'w') as fp:
+        json.dump(dict(version=SCHEMA_VERSION, fields=fields), fp, indent=1)
+    os.replace(tmp, os.path.join(path, SCHEMA_FILE))
+    return ColumnStore(path)
+
+
+class _LazyNpz:
+    # NpzFile decompresses a member on every access; hand members to
+    # write_store one by one so only a single array is resident at a time.
+    def __init__(self, npz):
+        self.npz = npz
+
+    def __iter__(self):
+        return iter(self.npz.files)
+
+    def __getitem__(self, name):
+        return self.npz[name]
+
+
+def convert_npz(npz_path, out_path=None, overwrite=False):
+    if out_path is None:
+        out_path = os.path.splitext(npz_path)[0]
+    if is_store(out_path) and not overwrite:
+        print(f'{out_path} already exists, skipping')
+        return ColumnStore(out_path)
+    with np.load(npz_path) as npz:
+        store = write_store(out_path, _LazyNpz(npz))
+    print(f'{npz_path} -> {out_path} ({len(store.files)} fields)')
+    return store
+
+
+def open_dataset(npz_path, mmap_mode='r'):
+    '''
+    Open the store next to ``npz_path`` (same name without the extension) if it
+    has been converted, otherwise fall back to the npz file itself.
+    '''
+    path = os.path.splitext(npz_path)[0]
+    if is_store(path):
+        return ColumnStore(path, mmap_mode=mmap_mode)
+    return np.load(npz_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert npz datasets into memory-mapped stores')
+    parser.add_argument('npz', nargs='*', help='npz files to convert')
+    parser.add_argument('--dataset', type=str, nargs='*', default=[], choices=['fc', 'kc', 'sp', 'poa'])
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    paths = list(args.npz) + [store_path(d) + '.npz' for d in args.dataset]
+    for path in paths:
+        convert_npz(path, overwrite=args.overwrite)
@@ -0,0 +1,36 @@
+import os
+import tensorflow as tf
+from tensorflow import keras
+
+
+def set_precision(precision):
+    '''
+    Global Keras dtype policy: 'float32', 'mixed_bfloat16' or 'mixed_float16'.
+    Mixed policies compute in 16 bit and keep float32 (master) weights; models
+    must be built after this is set. Keras wraps the optimizer in a loss scale
+    optimizer for mixed_float16 at compile time.
+    '''
+    keras.mixed_precision.set_global_policy(precision)
+
+
+def enable_compilation_cache(cache_dir):
+    '''
+    Persist XLA executables under ``cache_dir`` so that later runs with the same
+    model and shapes load them instead of recompiling. TF reads TF_XLA_FLAGS on
+    the first XLA compilation, so call this before the first jit-compiled step.
+    TF <= 2.15 cannot serialise CPU executables, so there the cache only holds
+    GPU ones and nothing is enabled without a GPU. Returns whether it is active.
+    '''
+    flags = os.environ.get('TF_XLA_FLAGS', '')
+    if '--tf_xla_persistent_cache_directory' in flags:
+        return True
+    flags += f' --tf_xla_persistent_cache_directory={os.path.abspath(cache_dir)}'
+    if tuple(int(v) for v in tf.__version__.split('.')[:2]) < (2, 16):
+        # TargetRegistry::lookupTarget fails for CPU executables, persist GPU ones only
+        if not tf.config.list_physical_devices('GPU'):
+            print(f'Warning: no GPU, the XLA compilation cache has no effect on CPU with TF {tf.__version__}; not enabled')
+            return False
+        flags += ' --tf_xla_persistent_cache_device_types=GPU'
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TF_XLA_FLAGS'] = flags.strip()
+    return True
@@ -0,0 +1,262 @@
+import numpy as np
+from sklearn.neighbors import BallTree, KDTree
+from sklearn.metrics import pairwise_distances
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+class NeighborIndex:
+    '''
+    Incrementally maintained k-nearest-neighbour lists.
+
+    Houses are identified by the integer id returned from ``add``. Reference
+    houses (the training set) are neighbour candidates; ``reference=False``
+    houses (the test set) only get neighbour lists of their own. A training
+    house never lists itself.
+
+    Points live in a static tree rebuilt from time to time plus a small
+    brute-force buffer of houses added since the last rebuild; removed houses
+    are tombstoned. ``add``/``remove`` only mark the rows whose lists can change
+    (rows closer to the touched house than their current k-th neighbour): the
+    row tree is queried around the touched houses within the largest k-th
+    neighbour distance, so an update costs O(changes * log N) plus the rows
+    found, and ``refresh`` re-queries just the marked rows.
+
+    metric='haversine' takes (lat, lon) in degrees and reports great-circle
+    distances on a sphere of the mean earth radius, in kilometres
+    (unit='km') or degrees of arc (unit='deg'). The dist_geo fields of the
+    ASI data.npz look like kilometres (fc: nearest 0.0024, median 0.12,
+    largest 11.1 over the 30 nearest neighbours, i.e. 2 m to 11 km inside one
+    city); they were computed on the ellipsoid, so rebuilt distances can differ
+    from them by up to ~0.5%. metric='euclidean' takes the feature vectors as
+    given: scale them first (build_neighbor_fields standardises them).
+    '''
+    def __init__(self, num_neighbors, metric='haversine', unit='km', rebuild_ratio=0.05, leaf_size=40):
+        if metric not in ('haversine', 'euclidean'):
+            raise ValueError(f'unsupported metric {metric}')
+        if unit not in ('km', 'deg'):
+            raise ValueError(f'unsupported unit {unit}')
+        self.num_neighbors = num_neighbors
+        self.metric = metric
+        self.rebuild_ratio = rebuild_ratio
+        self.leaf_size = leaf_size
+        self.dist_scale = 1.0 if metric != 'haversine' else (EARTH_RADIUS_KM if unit == 'km' else np.degrees(1.0))
+
+        self.size = 0
+        self.coords = None
+        self.is_ref = np.zeros(0, bool)
+        self.alive = np.zeros(0, bool)
+        self.nbr_idx = np.zeros((0, num_neighbors), np.int64)
+        self.nbr_dist = np.zeros((0, num_neighbors))
+
+        self._dirty = set()
+        self._incomplete = set()    # refreshed rows with fewer than k neighbours
+        self._max_kdist = 0.        # upper bound of the refreshed rows' k-th neighbour distance
+        self._fresh = np.zeros(0, np.int64)
+        self._stale = 0
+        self._ref_tree, self._ref_tree_ids = None, None
+        self._row_tree, self._row_tree_ids = None, None
+
+    def _to_internal(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        if self.metric == 'haversine':
+            return np.radians(points[:, :2])
+        return points
+
+    def _reserve(self, n):
+        capacity = len(self.alive)
+        if n <= capacity:
+            return
+        capacity = max(n, 2 * capacity, 1024)
+        dim = self.coords.shape[1] if self.coords is not None else self._dim
+        grow = lambda a, fill, shape: np.concatenate((a, np.full(shape, fill, a.dtype)))
+        extra = capacity - len(self.alive)
+        self.coords = grow(self.coords if self.coords is not None else np.zeros((0, dim)), 0, (extra, dim))
+        self.is_ref = grow(self.is_ref, False, extra)
+        self.alive = grow(self.alive, False, extra)
+        self.nbr_idx = grow(self.nbr_idx, -1, (extra, self.num_neighbors))
+        self.nbr_dist = grow(self.nbr_dist, np.inf, (extra, self.num_neighbors))
+
+    def _make_tree(self, X):
+        if self.metric == 'haversine':
+            return BallTree(X, leaf_size=self.leaf_size, metric='haversine')
+        return KDTree(X, leaf_size=self.leaf_size)
+
+    def rebuild(self):
+        live = np.flatnonzero(self.alive[:self.size])
+        refs = live[self.is_ref[live]]
+        self._ref_tree_ids = refs
+        self._ref_tree = self._make_tree(self.coords[refs]) if len(refs) else None
+        self._row_tree_ids = live
+        self._row_tree = self._make_tree(self.coords[live]) if len(live) else None
+        # tighten the bound while the rebuild is touching every row anyway
+        kdist = self.nbr_dist[live, -1]
+        self._max_kdist = float(np.max(kdist[np.isfinite(kdist)], initial=0.))
+        self._fresh = np.zeros(0, np.int64)
+        self._stale = 0
+
+    def _maybe_rebuild(self):
+        num_refs = 0 if self._ref_tree_ids is None else len(self._ref_tree_ids)
+        if self._ref_tree is None or len(self._fresh) + self._stale > self.rebuild_ratio * num_refs:
+            self.rebuild()
+
+    def _rows_near(self, points, radius):
+        # alive rows within ``radius`` of any of ``points``
+        found = []
+        if self._row_tree is not None:
+            hits = self._row_tree.query_radius(points, r=radius)
+            found.extend(self._row_tree_ids[h] for h in hits)
+        fresh = self._fresh[self.alive[self._fresh]]
+        if len(fresh):
+            d = pairwise_distances(points, self.coords[fresh], metric=self.metric)
+            found.append(fresh[np.any(d <= radius, 0)])
+        if not found:
+            return np.zeros(0, np.int64)
+        rows = np.unique(np.concatenate(found))
+        return rows[self.alive[rows]]
+
+    def _mark_affected(self, ids, removed):
+        # rows short of k neighbours take any new one; the others only one closer than their k-th
+        self._dirty.update(self._incomplete)
+        if self._max_kdist <= 0:
+            return
+        # pad the radius: a removed k-th neighbour sits exactly on it, and the tree's
+        # haversine can round differently from pairwise_distances
+        rows = self._rows_near(self.coords[ids], self._max_kdist * (1 + 1e-9))
+        if len(rows) == 0:
+            return
+        if removed:
+            hit = np.isin(self.nbr_idx[rows], ids).any(1)
+        else:
+            # not yet refreshed rows (infinite k-th distance) are dirty already
+            d = pairwise_distances(self.coords[rows], self.coords[ids], metric=self.metric)
+            hit = np.any(d < self.nbr_dist[rows, -1:], 1)
+        self._dirty.update(rows[hit].tolist())
+
+    def add(self, points, reference=True):
+        X = self._to_internal(points)
+        self._dim = X.shape[1]
+        ids = np.arange(self.size, self.size + len(X))
+        self._reserve(self.size + len(X))
+        self.coords[ids] = X
+        self.is_ref[ids] = reference
+        self.alive[ids] = True
+        self.size += len(X)
+
+        self._fresh = np.concatenate((self._fresh, ids))
+        self._dirty.update(ids.tolist())
+        if reference:
+            self._mark_affected(ids, removed=False)
+        self._maybe_rebuild()
+        return ids
+
+    def remove(self, ids):
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        ids = ids[self.alive[ids]]
+        refs = ids[self.is_ref[ids]]
+        self.alive[ids] = False
+        self._stale += len(ids)
+        self._dirty.difference_update(ids.tolist())
+        self._incomplete.difference_update(ids.tolist())
+        if len(refs):
+            self._mark_affected(refs, removed=True)
+        self._maybe_rebuild()
+
+    def _knn(self, rows):
+        k = self.num_neighbors
+        X = self.coords[rows]
+        cand_ids, cand_dist = [], []
+        if self._ref_tree is not None:
+            # enough extra columns to survive tombstones and the row itself
+            k_query = min(k + self._stale + 1, len(self._ref_tree_ids))
+            dist, pos = self._ref_tree.query(X, k=k_query)
+            cand_ids.append(self._ref_tree_ids[pos])
+            cand_dist.append(dist)
+        fresh = self._fresh[self.alive[self._fresh] & self.is_ref[self._fresh]]
+        if len(fresh):
+            cand_ids.append(np.broadcast_to(fresh, (len(rows), len(fresh))))
+            cand_dist.append(pairwise_distances(X, self.coords[fresh], metric=self.metric))
+
+        ids = np.concatenate(cand_ids, 1) if cand_ids else np.zeros((len(rows), 0), np.int64)
+        dist = np.concatenate(cand_dist, 1) if cand_dist else np.zeros((len(rows), 0))
+        valid = self.alive[ids] & (ids != rows[:, None])
+        dist = np.where(valid, dist, np.inf)
+        if ids.shape[1] < k:
+            pad = k - ids.shape[1]
+            ids = np.pad(ids, ((0, 0), (0, pad)), constant_values=-1)
+            dist = np.pad(dist, ((0, 0), (0, pad)), constant_values=np.inf)
+
+        order = np.lexsort((ids, dist))[:, :k]
+        ids = np.take_along_axis(ids, order, 1)
+        dist = np.take_along_axis(dist, order, 1)
+        ids[~np.isfinite(dist)] = -1
+        return ids, dist
+
+    def refresh(self, batch_size=4096):
+        '''Re-query the rows touched since the last refresh; returns their ids.'''
+        rows = np.array(sorted(self._dirty), dtype=np.int64)
+        rows = rows[self.alive[rows]]
+        for s in range(0, len(rows), batch_size):
+            batch = rows[s:s + batch_size]
+            self.nbr_idx[batch], self.nbr_dist[batch] = self._knn(batch)
+            kdist = self.nbr_dist[batch, -1]
+            complete = np.isfinite(kdist)
+            self._incomplete.difference_update(batch[complete].tolist())
+            self._incomplete.update(batch[~complete].tolist())
+            self._max_kdist = max(self._max_kdist, float(np.max(kdist[complete], initial=0.)))
+        self._dirty.clear()
+        return rows
+
+    def reference_ids(self):
+        live = np.flatnonzero(self.alive[:self.size])
+        return live[self.is_ref[live]]
+
+    def neighbors(self, ids, idx_dtype=np.int64, dist_dtype=np.float64):
+        '''
+        Neighbour lists of houses ``ids`` with indices expressed as positions in
+        ``reference_ids()``, i.e. rows of the Train_* arrays.
+        '''
+        self.refresh()
+        ids = np.asarray(ids, dtype=np.int64)
+        idx = self.nbr_idx[ids]
+        if np.any(idx < 0):
+            raise ValueError(f'fewer than {self.num_neighbors} reference houses available')
+        position = np.full(self.size, -1, np.int64)
+        refs = self.reference_ids()
+        position[refs] = np.arange(len(refs))
+        return position[idx].astype(idx_dtype), (self.nbr_dist[ids] * self.dist_scale).astype(dist_dtype)
+
+
+def build_neighbor_fields(Train_latlon, Test_latlon, Train_feat, Test_feat, num_neighbors, like=None):
+    '''
+    Build the Train_/Test_ idx_geo, dist_geo, idx_eucli, dist_eucli fields that
+    load_data_ours reads. ``like`` (an opened dataset) fixes the output dtypes
+    so the fields can be written back next to the existing ones.
+
+    dist_geo is in kilometres (see NeighborIndex). The euclidean neighbours are
+    taken on features standardised with the train mean and std + 0.1, the same
+    scaling load_data_ours applies; ASI's shipped dist_eucli may come from a
+    different scaling, so regenerate both sets of fields rather than mixing them.
+
+    Returns the fields and the two indexes, which can be kept to apply later
+    additions/removals with ``add``/``remove`` and ``neighbors``.
+    '''
+    idx_dtype = like['Train_idx_geo'].dtype if like is not None else np.int64
+    dist_dtype = like['Train_dist_geo'].dtype if like is not None else np.float64
+
+    feat_mean = np.mean(Train_feat, 0)
+    feat_std = np.std(Train_feat, 0) + 0.1
+
+    fields = dict()
+    indexes = dict()
+    for name, metric, train, test in [
+            ('geo', 'haversine', Train_latlon, Test_latlon),
+            ('eucli', 'euclidean', (Train_feat - feat_mean) / feat_std, (Test_feat - feat_mean) / feat_std)]:
+        index = NeighborIndex(num_neighbors, metric=metric)
+        train_ids = index.add(train, reference=True)
+        test_ids = index.add(test, reference=False)
+        fields[f'Train_idx_{name}'], fields[f'Train_dist_{name}'] = index.neighbors(train_ids, idx_dtype, dist_dtype)
+        fields[f'Test_idx_{name}'], fields[f'Test_dist_{name}'] = index.neighbors(test_ids, idx_dtype, dist_dtype)
+        indexes[name] = index
+    return fields, indexes
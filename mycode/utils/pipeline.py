@@ -0,0 +1,48 @@
+import math
+import numpy as np
+import tensorflow as tf
+
+
+def split_validation(inputs, y, val_ratio):
+    '''Hold out the last val_ratio of the rows, as keras' validation_split does.'''
+    split_at = int(math.floor(len(y) * (1. - val_ratio)))
+    train = tuple(x[:split_at] for x in inputs), y[:split_at]
+    val = tuple(x[split_at:] for x in inputs), y[split_at:]
+    return train, val
+
+
+def make_dataset(inputs, y=None, batch_size=250, shuffle=False, seed=None):
+    '''
+    tf.data pipeline over numpy (or memory-mapped) arrays. Batches are cut as
+    index ranges and each array is indexed with the whole batch in one numpy
+    call (in parallel, on the tf.data thread pool), so a memory-mapped store is
+    only read a batch at a time instead of being copied into a graph constant;
+    the next batches are prefetched while the model runs.
+    '''
+    arrays = tuple(inputs) + ((y,) if y is not None else ())
+    dtypes = tuple(tf.as_dtype(a.dtype) for a in arrays)
+
+    def take(idx):
+        idx = np.sort(idx)  # ascending rows read the mapped files in order; a batch is unordered anyway
+        return tuple(np.asarray(a[idx]) for a in arrays)
+
+    def gather(idx):
+        batch = tf.numpy_function(take, [idx], dtypes, stateful=False)
+        for t, a in zip(batch, arrays):
+            t.set_shape((None,) + a.shape[1:])
+        x = tuple(batch[:len(inputs)])
+        return (x, batch[-1]) if y is not None else (x,)
+
+    ds = tf.data.Dataset.range(len(inputs[0]))
+    if shuffle:
+        ds = ds.shuffle(len(inputs[0]), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size)
+    ds = ds.map(gather, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+def make_train_val_datasets(inputs, y, batch_size, val_ratio, seed=None):
+    (train_x, train_y), (val_x, val_y) = split_validation(inputs, y, val_ratio)
+    train_ds = make_dataset(train_x, train_y, batch_size, shuffle=True, seed=seed)
+    val_ds = make_dataset(val_x, val_y, batch_size)
+    return train_ds, val_ds
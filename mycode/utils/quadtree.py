@@ -0,0 +1,118 @@
+import heapq
+import numpy as np
+
+
+class QuadTree:
+    '''
+    Adaptive area index over (lat, lon). Starting from the grid bounds, the cell
+    holding the most points is split into four quadrants while it holds more
+    than ``capacity`` points, until ``max_cells`` leaves or ``max_depth``.
+    Dense areas end up with small cells, empty areas stay one big cell.
+
+    Node arrays: bounds (minx, miny, maxx, maxy), ``child`` (index of the first
+    of four consecutive children, -1 for a leaf) and ``leaf_id``. Children are
+    ordered (x < mid, y < mid), (x >= mid, y < mid), (x < mid, y >= mid),
+    (x >= mid, y >= mid).
+    '''
+    def __init__(self, minx, miny, maxx, maxy, child, depth):
+        self.minx, self.miny, self.maxx, self.maxy = minx, miny, maxx, maxy
+        self.child = child
+        self.depth = depth
+        self.midx = (minx + maxx) / 2
+        self.midy = (miny + maxy) / 2
+        leaves = np.flatnonzero(child < 0)
+        self.leaf_id = np.full(len(child), -1, dtype=np.int64)
+        self.leaf_id[leaves] = np.arange(len(leaves))
+        self.leaves = leaves
+
+    @property
+    def num_cells(self):
+        return len(self.leaves)
+
+    @classmethod
+    def build(cls, bounds, latlon, weights=None, capacity=32, max_cells=10000, max_depth=12):
+        '''
+        bounds: (minx, miny, maxx, maxy) in lon/lat; latlon: (n, 2) house (and
+        optionally road vertex) coordinates; weights: per-point density weight.
+        '''
+        latlon = np.asarray(latlon, dtype=np.float64)
+        x, y = latlon[:, 1], latlon[:, 0]
+        weights = np.ones(len(latlon)) if weights is None else np.asarray(weights, dtype=np.float64)
+
+        box = [list(bounds)]
+        child = [-1]
+        depth = [0]
+        members = {0: np.arange(len(latlon))}
+        heap = [(-weights.sum(), 0)]
+        num_leaves = 1
+        while heap and num_leaves + 3 <= max_cells:
+            load, node = heapq.heappop(heap)
+            if -load <= capacity:
+                break
+            if depth[node] >= max_depth:
+                continue
+            x0, y0, x1, y1 = box[node]
+            mx, my = (x0 + x1) / 2, (y0 + y1) / 2
+            idx = members.pop(node)
+            quad = (x[idx] >= mx).astype(np.int64) + 2 * (y[idx] >= my)
+            first = len(box)
+            child[node] = first
+            box += [[x0, y0, mx, my], [mx, y0, x1, my], [x0, my, mx, y1], [mx, my, x1, y1]]
+            for k in range(4):
+                sub = idx[quad == k]
+                members[first + k] = sub
+                child.append(-1)
+                depth.append(depth[node] + 1)
+                heapq.heappush(heap, (-weights[sub].sum(), first + k))
+            num_leaves += 3
+
+        box = np.array(box)
+        return cls(box[:, 0], box[:, 1], box[:, 2], box[:, 3], np.array(child, dtype=np.int64), max(depth))
+
+    def lookup(self, latlon):
+        '''Leaf id of every (lat, lon); points outside the bounds go to the nearest border leaf.'''
+        latlon = np.asarray(latlon, dtype=np.float64)
+        x, y = latlon[:, 1], latlon[:, 0]
+        node = np.zeros(len(latlon), dtype=np.int64)
+        for _ in range(self.depth):
+            inner = np.flatnonzero(self.child[node] >= 0)
+            if len(inner) == 0:
+                break
+            n = node[inner]
+            quad = (x[inner] >= self.midx[n]).astype(np.int64) + 2 * (y[inner] >= self.midy[n])
+            node[inner] = self.child[n] + quad
+        return self.leaf_id[node]
+
+    def embedding_table(self, grid_emb, nrows, ncols):
+        '''
+        (num_cells, channels) table from the lookup table of a regular
+        nrows x ncols grid over the same bounds, where grid cell g reads row g
+        (as the grid path gathers it; load_flat's default layout has one scalar
+        per row, --area_emb_full whole rows). Each leaf averages the rows of the
+        grid cells whose centres it contains, or takes the row of the grid cell
+        under its own centre if it is smaller than one grid cell.
+        '''
+        grid_emb = np.asarray(grid_emb)
+        if len(grid_emb) < nrows * ncols:
+            raise ValueError(f'grid embedding has {len(grid_emb)} rows, expected at least {nrows * ncols}')
+        grid_emb = grid_emb[:nrows * ncols].reshape(nrows * ncols, -1)
+        minx, miny, maxx, maxy = self.minx[0], self.miny[0], self.maxx[0], self.maxy[0]
+        width = (maxx - minx) / ncols
+        height = (maxy - miny) / nrows
+
+        i = np.tile(np.arange(ncols), nrows)
+        j = np.repeat(np.arange(nrows), ncols)
+        centres = np.stack((miny + (j + 0.5) * height, minx + (i + 0.5) * width), -1)
+        cell_leaf = self.lookup(centres)
+
+        table = np.zeros((self.num_cells, grid_emb.shape[1]), dtype=np.float64)
+        np.add.at(table, cell_leaf, grid_emb)
+        count = np.bincount(cell_leaf, minlength=self.num_cells)
+
+        empty = np.flatnonzero(count == 0)
+        leaves = self.leaves[empty]
+        ci = np.clip(((self.midx[leaves] - minx) / width).astype(int), 0, ncols - 1)
+        cj = np.clip(((self.midy[leaves] - miny) / height).astype(int), 0, nrows - 1)
+        table[empty] = grid_emb[ci + cj * ncols]
+        count[empty] = 1
+        return (table / count[:, np.newaxis]).astype(grid_emb.dtype)